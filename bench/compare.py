@@ -0,0 +1,46 @@
+import json
+import sys
+
+#################################
+# 벤치마크 결과 비교
+#   python -m bench.compare 이전.json 이후.json
+#################################
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)):
+            out[key] = v
+    return out
+
+def main(a_path, b_path):
+    with open(a_path, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(b_path, encoding="utf-8") as f:
+        b = json.load(f)
+
+    if a["scenario"] != b["scenario"]:
+        print(f"⚠️ 시나리오가 다름: {a['scenario']} vs {b['scenario']}")
+
+    fa, fb = flatten(a["metrics"]), flatten(b["metrics"])
+    width = max(len(k) for k in fa.keys() | fb.keys())
+
+    print(f"{'metric':<{width}}  {a['git_rev']:>12}  {b['git_rev']:>12}  {'change':>8}")
+    for k in sorted(fa.keys() | fb.keys()):
+        va, vb = fa.get(k), fb.get(k)
+        if va is None or vb is None:
+            change = ""
+        elif va == 0:
+            change = "" if vb == 0 else "new"
+        else:
+            change = f"{(vb - va) / abs(va) * 100:+.1f}%"
+        print(f"{k:<{width}}  {va if va is not None else '-':>12}  {vb if vb is not None else '-':>12}  {change:>8}")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("사용법: python -m bench.compare 이전.json 이후.json")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2])
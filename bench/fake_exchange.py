@@ -0,0 +1,104 @@
+import asyncio
+import math
+import random
+import time
+
+from bench.stub_http import StubServer
+
+#################################
+# 가짜 업비트/빗썸 REST (지연·오류율·마켓 크기 조절)
+#################################
+
+class FakeExchange(StubServer):
+    # 한 서버가 업비트 경로(/v1/...)와 빗썸 경로(/public/...)를 모두 처리
+    def __init__(self, market_size=200, latency=0.02, jitter=0.01, error_rate=0.0, seed=1):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+        self.coins = ["BTC", "ETH"] + [f"C{i:04d}" for i in range(max(0, market_size - 2))]
+        self.base = {c: 10 ** self.rng.uniform(0, 7) for c in self.coins}
+        self.phase = {c: self.rng.uniform(0, 2 * math.pi) for c in self.coins}
+        self.t0 = time.time()
+
+    def prices(self, coin):
+        # 업비트/빗썸 괴리가 ±2% 안에서 천천히 출렁이도록
+        t = time.time() - self.t0
+        base = self.base[coin]
+        up = base * (1 + 0.01 * math.sin(t / 7 + self.phase[coin]))
+        bt = up * (1 - 0.02 * math.sin(t / 11 + self.phase[coin]))
+        return up, bt
+
+    def book(self, price, levels=15):
+        # 가격 위아래 0.05% 간격 호가, 한 호가당 약 100만원어치 → [((매도, 매수), 수량)]
+        qty = 1_000_000 / price
+        return [
+            ((price * (1 + 0.0005 * (i + 1)), price * (1 - 0.0005 * (i + 1))), qty)
+            for i in range(levels)
+        ]
+
+    async def route(self, method, path, query, body):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rng.random() < self.error_rate:
+            return 500, {"error": "injected"}
+
+        if path == "/v1/market/all":
+            return 200, [{"market": f"KRW-{c}"} for c in self.coins]
+
+        if path == "/v1/ticker":
+            markets = query.get("markets", "").split(",")
+            coins = [m.replace("KRW-", "") for m in markets]
+            if any(c not in self.base for c in coins):
+                return 404, {"error": {"name": "404", "message": "Code not found"}}
+            return 200, [{"market": f"KRW-{c}", "trade_price": self.prices(c)[0]} for c in coins]
+
+        if path == "/v1/orderbook":
+            markets = query.get("markets", "").split(",")
+            coins = [m.replace("KRW-", "") for m in markets]
+            if any(c not in self.base for c in coins):
+                return 404, {"error": {"name": "404", "message": "Code not found"}}
+            return 200, [
+                {"market": f"KRW-{c}", "orderbook_units": [
+                    {"ask_price": a, "ask_size": q, "bid_price": b, "bid_size": q}
+                    for (a, b), q in self.book(self.prices(c)[0])
+                ]}
+                for c in coins
+            ]
+
+        if path == "/v1/status/wallet":
+            return 200, [{"currency": c, "wallet_state": "working"} for c in self.coins]
+
+        if path == "/public/ticker/ALL_KRW":
+            data = {c: {"closing_price": f"{self.prices(c)[1]:.4f}"} for c in self.coins}
+            data["date"] = str(int(time.time() * 1000))
+            return 200, {"status": "0000", "data": data}
+
+        if path.startswith("/public/ticker/"):
+            coin = path.rsplit("/", 1)[1].replace("_KRW", "")
+            if coin not in self.base:
+                return 200, {"status": "5500", "message": "Invalid Parameter"}
+            return 200, {"status": "0000", "data": {"closing_price": f"{self.prices(coin)[1]:.4f}"}}
+
+        if path == "/public/orderbook/ALL_KRW":
+            data = {"timestamp": str(int(time.time() * 1000)), "payment_currency": "KRW"}
+            for c in self.coins:
+                levels = self.book(self.prices(c)[1])[:5]
+                data[c] = {
+                    "order_currency": c,
+                    "asks": [{"price": f"{a:.4f}", "quantity": f"{q:.6f}"} for (a, _), q in levels],
+                    "bids": [{"price": f"{b:.4f}", "quantity": f"{q:.6f}"} for (_, b), q in levels],
+                }
+            return 200, {"status": "0000", "data": data}
+
+        if path == "/public/assetsstatus/ALL":
+            data = {c: {"deposit_status": 1, "withdrawal_status": 1} for c in self.coins}
+            return 200, {"status": "0000", "data": data}
+
+        if path.startswith("/public/assetsstatus/"):
+            return 200, {"status": "0000", "data": {"deposit_status": 1, "withdrawal_status": 1}}
+
+        return 404, {"error": "not found"}
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+from bench.stub_http import StubServer, parse_body
+
+#################################
+# 가짜 Telegram Bot API (getMe / sendMessage)
+#################################
+
+class FakeTelegram(StubServer):
+    def __init__(self, latency=0.01):
+        super().__init__()
+        self.latency = latency
+        self.sent = []  # (시각, chat_id, 글자수)
+        self.message_id = 0
+
+    async def route(self, method, path, query, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = path.rsplit("/", 1)[1]
+        params = parse_body(body)
+
+        if name == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+            }}
+
+        if name == "sendMessage":
+            self.message_id += 1
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            self.sent.append((time.time(), chat_id, len(text)))
+            return 200, {"ok": True, "result": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }}
+
+        return 200, {"ok": True, "result": True}
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import websockets
+
+#################################
+# 가짜 업비트/빗썸 시세 WebSocket (STREAM_MODE 테스트용)
+#
+#   업비트: /websocket/v1  ← [{"ticket"}, {"type": "ticker", "codes": ["KRW-BTC"]}]
+#   빗썸:   /pub/ws        ← {"type": "ticker", "symbols": ["BTC_KRW"], "tickTypes": ["MID"]}
+#
+# 가격은 FakeExchange 와 같은 값 → REST 시드와 스트림 가격이 맞물림
+#################################
+
+class FakeTicker:
+    def __init__(self, fx, interval=0.2):
+        self.fx = fx
+        self.interval = interval  # 구독 코인마다 이 간격으로 체결 푸시
+        self.server = None
+        self.port = None
+        self.conns = set()
+        self.connects = {"upbit": 0, "bithumb": 0}  # 거래소 → (재)연결 수
+        self.pushed = {"upbit": 0, "bithumb": 0}    # 거래소 → 보낸 체결 수
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await websockets.serve(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def upbit_url(self):
+        return f"ws://127.0.0.1:{self.port}/websocket/v1"
+
+    @property
+    def bithumb_url(self):
+        return f"ws://127.0.0.1:{self.port}/pub/ws"
+
+    async def drop(self):
+        # 스트림 끊김 흉내 → 클라이언트 재연결/REST 폴백 확인용
+        for ws in list(self.conns):
+            await ws.close()
+
+    def subscribe(self, exchange, msg):
+        # 구독 메시지 → 코인 목록
+        d = json.loads(msg)
+        if exchange == "upbit":
+            codes = next(x["codes"] for x in d if x.get("type") == "ticker")
+            return [c.replace("KRW-", "") for c in codes]
+        return [s.replace("_KRW", "") for s in d["symbols"]]
+
+    def tick(self, exchange, coin):
+        up, bt = self.fx.prices(coin)
+        if exchange == "upbit":
+            return {"type": "ticker", "code": f"KRW-{coin}", "trade_price": up}
+        return {"type": "ticker", "content": {"symbol": f"{coin}_KRW", "closePrice": f"{bt:.4f}"}}
+
+    async def _handle(self, ws):
+        path = ws.request.path
+        if path == "/websocket/v1":
+            exchange = "upbit"
+        elif path == "/pub/ws":
+            exchange = "bithumb"
+        else:
+            await ws.close(1008, "not found")
+            return
+
+        self.connects[exchange] += 1
+        self.conns.add(ws)
+        try:
+            if exchange == "bithumb":
+                await ws.send(json.dumps({"status": "0000", "resmsg": "Connected Successfully"}))
+            coins = [c for c in self.subscribe(exchange, await ws.recv()) if c in self.fx.base]
+            if exchange == "bithumb":
+                await ws.send(json.dumps({"status": "0000", "resmsg": "Filter Registered Successfully"}))
+
+            while True:
+                for coin in coins:
+                    await ws.send(json.dumps(self.tick(exchange, coin)))
+                    self.pushed[exchange] += 1
+                await asyncio.sleep(self.interval)
+        except (websockets.ConnectionClosed, ConnectionError):
+            pass
+        finally:
+            self.conns.discard(ws)
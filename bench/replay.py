@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+#################################
+# 알람 리플레이 (기록된/합성 시세로 알람·쿨다운 규칙을 오프라인 재생)
+#
+#   python -m bench.replay --history data/history --days 7 --pct 0.5 --night
+#   python -m bench.replay --history data/history --days 7 --db
+#   python -m bench.replay --synthetic --coins 50 --ticks 100000 --alarms 5000 --verify
+#   python -m bench.replay --synthetic --save ticks.npz   /   --load ticks.npz ...
+#
+# 판정 규칙은 main 것을 그대로 씀
+#   (밤모드 2배 = is_night_time(가상 시각), 2번 울리고 COOLDOWN_SEC = alarm_wait/alarm_next_count, net_profit)
+# 빠른 경로: 코인별 가격차를 numpy로 한 번에 → 임계값 넘는 구간마다 울린 틱만 이진탐색
+# --verify: 같은 틱을 main.evaluate_alarms 에 시각순으로 넣어 울린 시각이 전부 같은지 확인
+#################################
+
+def load_main(args):
+    # main은 import 시점에 환경변수를 읽음 → 실제 DB가 필요 없으면 임시 폴더
+    if not args.db:
+        os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="replay-")
+    os.environ.setdefault("BOT_TOKEN", "123:replay")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    return main
+
+#################################
+# 입력 (시세 기록 / 합성 / npz)
+#################################
+
+def from_history(main, root, days):
+    rec = main.HistoryRecorder(root)
+    t1 = int(time.time())
+    return rec.raw(t1 - int(days * 86400), t1 + 1)
+
+def synthetic(main, coins, ticks, step, seed):
+    # 기록 쌍(main.HISTORY_PAIR) 앞쪽은 로그 랜덤워크, 뒤쪽은 ±2% 안에서 출렁이는 괴리 + 잡음
+    rng = np.random.default_rng(seed)
+    names = (["BTC", "ETH"] + [f"C{i:04d}" for i in range(max(0, coins - 2))])[:coins]
+    base = 10 ** rng.uniform(0, 7, coins)
+    period = rng.uniform(600, 6 * 3600, coins)
+    phase = rng.uniform(0, 2 * np.pi, coins)
+
+    start = int(time.time()) - ticks * step
+    ts = start + np.arange(ticks, dtype=np.int64) * step
+    up = base * np.exp(np.cumsum(rng.normal(0, 0.0005, (ticks, coins)), axis=0))
+    gap = 0.015 * np.sin(2 * np.pi * ts[:, None] / period + phase) + rng.normal(0, 0.002, (ticks, coins))
+    bt = up * (1 - gap)
+
+    rows = np.zeros(ticks * coins, main.RAW_DTYPE)
+    rows["ts"] = np.repeat(ts, coins)
+    rows["coin"] = np.tile(np.arange(coins), ticks)
+    rows[main.HISTORY_PAIR[0]] = up.ravel()
+    rows[main.HISTORY_PAIR[1]] = bt.ravel()
+    rows["gap"] = (gap * 100).ravel()
+    return rows, names
+
+def save_ticks(path, rows, names):
+    np.savez_compressed(path, ticks=rows, coins=np.array(names))
+
+def load_ticks(path):
+    data = np.load(path)
+    return data["ticks"], [str(c) for c in data["coins"]]
+
+def split_by_coin(rows):
+    # → {코인번호: 그 코인의 틱 (시각순)}
+    rows = rows[np.argsort(rows["coin"], kind="stable")]
+    bounds = np.flatnonzero(np.diff(rows["coin"])) + 1
+    return {int(part["coin"][0]): part for part in np.split(rows, bounds) if len(part)}
+
+#################################
+# 알람 목록 (DB / 퍼센트 규칙 / 무작위)
+#################################
+
+def _alarm(main, i, chat_id, coin, hi, lo, diff):
+    return {
+        "id": f"r{i:06d}", "chat_id": chat_id, "username": "replay",
+        "ex_high": hi, "ex_low": lo,
+        "kr_high": main.EXCHANGE_NAME[hi], "kr_low": main.EXCHANGE_NAME[lo],
+        "coin": coin, "diff": diff,
+    }
+
+def pct_alarms(main, by_coin, names, pct, night):
+    # 코인마다 양방향 알람 1개씩, 차익 = 기간 중간값 가격의 pct%
+    pair = main.HISTORY_PAIR
+    alarms = []
+    for cid, part in by_coin.items():
+        ref = float(np.median(part[pair[1]]))
+        for hi, lo in (pair, pair[::-1]):
+            alarms.append(_alarm(main, len(alarms), 1, names[cid], hi, lo, round(ref * pct / 100, 8)))
+    return alarms, {"1": night}
+
+def random_alarms(main, by_coin, names, n, chats, night, seed):
+    # bench.run alarms 시나리오와 같은 분포: 코인 가격 대비 0.1%~3% 차익
+    rng = random.Random(seed)
+    pair = main.HISTORY_PAIR
+    coins = sorted(by_coin)
+    alarms = []
+    for i in range(n):
+        cid = rng.choice(coins)
+        hi, lo = rng.choice([pair, pair[::-1]])
+        ref = float(by_coin[cid][pair[1]][0])
+        alarms.append(_alarm(main, i, 1000 + rng.randrange(chats), names[cid], hi, lo, round(ref * rng.uniform(0.001, 0.03), 8)))
+    return alarms, {str(1000 + c): night for c in range(chats)}
+
+#################################
+# 빠른 경로 (numpy)
+#################################
+
+def fire_ticks(ts, over, main):
+    # over: 틱마다 임계값 이상인지 → 울린 틱 인덱스
+    # 임계값 아래로 내려가면 상태 리셋 → 넘는 구간마다 첫 틱에 울리고, 이후는 alarm_wait 만큼 뒤 첫 틱
+    if not over.any():
+        return [], 0
+    edges = np.diff(over.astype(np.int8), prepend=0, append=0)
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    fired = []
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        i, count = s, 0
+        while i < e:
+            fired.append(i)
+            count = main.alarm_next_count(count)
+            i = i + 1 + int(np.searchsorted(ts[i + 1:e], ts[i] + main.alarm_wait(count), side="left"))
+    return fired, len(starts)
+
+def replay_fast(main, by_coin, names, alarms, night):
+    # → {알람id: {"fires": [시각...], "profits": [...], "episodes": n, "night_fires": n}}, 평가한 알람×틱 수
+    coin_ids = {c: i for i, c in enumerate(names)}
+    groups = {}
+    for a in alarms:
+        groups.setdefault((a["coin"], a["ex_high"], a["ex_low"]), []).append(a)
+
+    report, work = {}, 0
+    for (coin, hi, lo), members in groups.items():
+        part = by_coin.get(coin_ids.get(coin))
+        if part is None:
+            for a in members:
+                report[a["id"]] = {"fires": [], "profits": [], "episodes": 0, "night_fires": 0}
+            continue
+
+        ts = part["ts"].astype(np.int64)
+        high, low = part[hi], part[lo]
+        raw = high - low
+        gap = np.round(raw, 8)
+        is_night = main.is_night_time(ts)
+
+        for a in members:
+            day = a["diff"]
+            thr = day
+            if night.get(str(a["chat_id"]), False):
+                thr = np.where(is_night, day * 2, day)
+            over = gap >= thr
+
+            # np.round 과 파이썬 round 가 경계에서 다를 수 있음 → 임계값에 딱 붙은 틱만 main과 같은 식으로 다시 판정
+            edge = np.flatnonzero(np.isclose(gap, thr, rtol=1e-12, atol=1e-9))
+            for j in edge.tolist():
+                t = thr if np.isscalar(thr) else thr[j]
+                over[j] = round(float(high[j]) - float(low[j]), 8) >= t
+
+            idx, episodes = fire_ticks(ts, over, main)
+            report[a["id"]] = {
+                "fires": [int(ts[j]) for j in idx],
+                "profits": [main.net_profit(a, float(high[j]), float(low[j]), round(float(high[j]) - float(low[j]), 8)) for j in idx],
+                "episodes": episodes,
+                "night_fires": int(is_night[idx].sum()) if idx else 0,
+            }
+            work += len(ts)
+    return report, work
+
+#################################
+# 검증 경로 (main.evaluate_alarms 그대로)
+#################################
+
+async def replay_exact(main, rows, names, alarms, night):
+    # 시각별 스냅샷을 만들어 실제 평가 함수에 가상 시각으로 넣음 → 울린 시각만 기록
+    main.ALARM_INDEX.rebuild(alarms, night)
+    main.ALERT_STATE.__init__()
+    fired = {a["id"]: [] for a in alarms}
+
+    fire = main.ALERT_STATE.fire
+    def record(alarm_id, now, count):
+        fired[alarm_id].append(int(now))
+        fire(alarm_id, now, count)
+    main.ALERT_STATE.fire = record
+    main.DISPATCHER.enqueue = lambda *a, **k: None
+
+    rows = rows[np.argsort(rows["ts"], kind="stable")]
+    bounds = np.flatnonzero(np.diff(rows["ts"])) + 1
+    for block in np.split(rows, bounds):
+        if not len(block):
+            continue
+        coins = [names[c] for c in block["coin"].tolist()]
+        snapshot = {ex: dict(zip(coins, block[ex].tolist())) for ex in main.HISTORY_PAIR}
+        keys = [k for c in coins for k in main.ALARM_INDEX.by_coin.get(c, ())]
+        if keys:
+            await main.evaluate_alarms(None, snapshot, keys, now=float(block["ts"][0]))
+    return fired
+
+#################################
+# 보고서
+#################################
+
+def summarize(main, alarms, report):
+    out = []
+    for a in alarms:
+        r = report[a["id"]]
+        profits = r["profits"]
+        out.append({
+            "id": a["id"], "chat_id": a["chat_id"], "coin": a["coin"],
+            "rule": f"{a['kr_high']}→{a['kr_low']} {a['diff']}원",
+            "messages": len(r["fires"]),
+            "episodes": r["episodes"],
+            "night_messages": r["night_fires"],
+            "first": r["fires"][0] if r["fires"] else None,
+            "last": r["fires"][-1] if r["fires"] else None,
+            "net_profit_mean": round(sum(profits) / len(profits), 8) if profits else None,
+            "net_profit_max": max(profits) if profits else None,
+        })
+    return out
+
+def print_report(main, rows, top):
+    total = sum(r["messages"] for r in rows)
+    print(f"알람 {len(rows)}개 → 메시지 {total}건 (밤 {sum(r['night_messages'] for r in rows)}건)")
+    busiest = sorted(rows, key=lambda r: -r["messages"])[:top]
+    for r in busiest:
+        if not r["messages"]:
+            break
+        print(
+            f"  {r['id']} {r['coin']:<6} {r['rule']:<24} "
+            f"{r['messages']:>5}건 / 구간 {r['episodes']:>4} | "
+            f"{main._kst(r['first'])} ~ {main._kst(r['last'])} | 평균 순이익 {main.fmt(r['net_profit_mean'])}원"
+        )
+
+def run(args):
+    main = load_main(args)
+    from bench.run import RESULTS_DIR, git_rev
+
+    if args.load:
+        rows, names = load_ticks(args.load)
+    elif args.synthetic:
+        rows, names = synthetic(main, args.coins, args.ticks, args.step, args.seed)
+    else:
+        rows, names = from_history(main, args.history or main.HISTORY_DIR, args.days)
+    if args.save:
+        save_ticks(args.save, rows, names)
+        print(f"→ {args.save}")
+    if not len(rows):
+        print("틱 없음")
+        return 1
+
+    by_coin = split_by_coin(rows)
+    if args.db:
+        main.db()
+        alarms, night = main.load_alarms(), main.load_night()
+        # 기록에는 HISTORY_PAIR 두 거래소 가격만 있음 → 다른 쌍 알람은 재생 불가
+        pair = set(main.HISTORY_PAIR)
+        skipped = [a for a in alarms if {a["ex_high"], a["ex_low"]} != pair]
+        if skipped:
+            print(f"[리플레이] 기록에 없는 거래소쌍 알람 {len(skipped)}개 제외")
+            alarms = [a for a in alarms if {a["ex_high"], a["ex_low"]} == pair]
+    elif args.pct is not None:
+        alarms, night = pct_alarms(main, by_coin, names, args.pct, args.night)
+    else:
+        alarms, night = random_alarms(main, by_coin, names, args.alarms, args.chats, args.night, args.seed)
+
+    t = time.perf_counter()
+    report, work = replay_fast(main, by_coin, names, alarms, night)
+    fast = time.perf_counter() - t
+    rows_out = summarize(main, alarms, report)
+
+    metrics = {
+        "ticks": int(len(rows)),
+        "alarms": len(alarms),
+        "alarm_ticks": work,
+        "messages": sum(r["messages"] for r in rows_out),
+        "fast_ms": round(fast * 1000, 3),
+        "alarm_ticks_per_sec": round(work / fast) if fast else 0,
+    }
+
+    if args.verify:
+        t = time.perf_counter()
+        exact = asyncio.run(replay_exact(main, rows, names, alarms, night))
+        metrics["exact_ms"] = round((time.perf_counter() - t) * 1000, 3)
+        bad = [aid for aid in exact if exact[aid] != report[aid]["fires"]]
+        metrics["mismatches"] = len(bad)
+        for aid in bad[:5]:
+            print(f"[불일치] {aid} 빠른경로 {report[aid]['fires'][:6]} / evaluate_alarms {exact[aid][:6]}")
+
+    print_report(main, rows_out, args.top)
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+
+    result = {
+        "scenario": "replay",
+        "git_rev": git_rev(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "metrics": metrics,
+        "alarms": rows_out,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = args.out or os.path.join(RESULTS_DIR, f"replay-{result['git_rev']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"→ {out}")
+    return 1 if metrics.get("mismatches") else 0
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.replay")
+    src = p.add_mutually_exclusive_group()
+    src.add_argument("--history", help="시세 기록 폴더 (기본 main.HISTORY_DIR)")
+    src.add_argument("--synthetic", action="store_true", help="합성 시세")
+    src.add_argument("--load", help="--save 로 저장한 npz")
+    p.add_argument("--days", type=float, default=7, help="--history 에서 최근 며칠")
+    p.add_argument("--save", help="입력 틱을 npz로 저장")
+    p.add_argument("--coins", type=int, default=50)
+    p.add_argument("--ticks", type=int, default=100000, help="합성 시세 코인당 틱 수")
+    p.add_argument("--step", type=int, default=5, help="합성 시세 틱 간격(초)")
+
+    rule = p.add_mutually_exclusive_group()
+    rule.add_argument("--db", action="store_true", help="DATA_DIR 의 실제 알람/밤모드 설정")
+    rule.add_argument("--pct", type=float, help="코인마다 양방향, 가격의 pct%% 차익 알람")
+    p.add_argument("--alarms", type=int, default=1000, help="무작위 알람 수 (--db/--pct 없을 때)")
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--night", action="store_true", help="모든 채팅 밤모드 ON")
+
+    p.add_argument("--verify", action="store_true", help="main.evaluate_alarms 결과와 비교")
+    p.add_argument("--top", type=int, default=20, help="보고서에 보여줄 알람 수")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
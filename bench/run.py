@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from bench.fake_exchange import FakeExchange
+from bench.fake_telegram import FakeTelegram
+from bench.fake_ws import FakeTicker
+
+#################################
+# 부하/성능 측정 (가짜 거래소 + 가짜 텔레그램)
+#
+#   python -m bench.run alarms --alarms 10000 --coins 200 --ticks 20
+#   python -m bench.run gap_auto --subs 500
+#   python -m bench.run status_burst --concurrency 100
+#   python -m bench.run stream --alarms 1000 --duration 5
+#   python -m bench.run all
+#
+# 결과: bench/results/<시나리오>-<시각>.json → python -m bench.compare A.json B.json
+#################################
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+SCENARIOS = ("alarms", "gap_auto", "status_burst", "stream")
+
+def pct(values, p):
+    if not values:
+        return 0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+def summarize(values, scale=1000):
+    # 초 단위 목록 → ms 백분위
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values) * scale, 3) if values else 0,
+        "p50": round(pct(values, 0.50) * scale, 3),
+        "p90": round(pct(values, 0.90) * scale, 3),
+        "p99": round(pct(values, 0.99) * scale, 3),
+        "max": round(max(values) * scale, 3) if values else 0,
+    }
+
+class LoopLag:
+    # 10ms마다 깨어나서 늦게 깬 만큼을 이벤트 루프 블로킹으로 기록
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0, time.perf_counter() - t - self.interval))
+
+    def start(self):
+        self.samples = []
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+        return {
+            **summarize(self.samples),
+            "blocked_total_ms": round(sum(s for s in self.samples if s > 0.005) * 1000, 3),
+        }
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+async def setup(args):
+    fx = await FakeExchange(
+        market_size=args.coins, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, seed=args.seed
+    ).start()
+    tg = await FakeTelegram(latency=args.tg_latency).start()
+    ws = await FakeTicker(fx, interval=args.ws_interval).start()
+
+    # main은 import 시점에 환경변수를 읽음
+    os.environ["UPBIT_API_URL"] = fx.url
+    os.environ["BITHUMB_API_URL"] = fx.url
+    os.environ["UPBIT_WS_URL"] = ws.upbit_url
+    os.environ["BITHUMB_WS_URL"] = ws.bithumb_url
+    os.environ["TELEGRAM_API_URL"] = tg.url
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("BOT_TOKEN", "123:bench")
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    # ApplicationBuilder 기본값처럼 커넥션 풀을 넉넉히
+    bot = Bot(
+        os.environ["BOT_TOKEN"],
+        base_url=f"{tg.url}/bot",
+        request=HTTPXRequest(connection_pool_size=256),
+    )
+    await bot.initialize()
+
+    main.db()
+    return main, fx, tg, bot, ws
+
+def fresh_tick(main):
+    # 실제 루프는 틱 간격만큼 캐시가 식으므로 매 틱 캐시를 비움
+    main.PRICE_CACHE.entries.clear()
+    main.PRICE_CACHE.full.clear()
+
+def fake_update(bot, i, chat_id, text):
+    from telegram import Update
+    return Update.de_json({
+        "update_id": i,
+        "message": {
+            "message_id": i,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}"},
+            "text": text,
+        },
+    }, bot)
+
+def seed_alarms(args, main, fx):
+    rng = random.Random(args.seed)
+    coins = fx.coins[:args.coins]
+    pairs = [("upbit", "bithumb", "업비트", "빗썸"), ("bithumb", "upbit", "빗썸", "업비트")]
+
+    for i in range(args.alarms):
+        coin = rng.choice(coins)
+        hi, lo, kr_hi, kr_lo = rng.choice(pairs)
+        main.add_alarm({
+            "id": main.new_alarm_id(),
+            "chat_id": 1000 + rng.randrange(args.chats),
+            "username": "bench",
+            "ex_high": hi, "ex_low": lo, "kr_high": kr_hi, "kr_low": kr_lo,
+            "coin": coin,
+            # 코인 가격 대비 0.1%~3% 차익
+            "diff": round(fx.base[coin] * rng.uniform(0.001, 0.03), 8),
+        })
+    main.ALARM_INDEX.rebuild(main.load_alarms(), main.load_night())
+
+async def scenario_alarms(args, main, fx, tg, bot, ws):
+    seed_alarms(args, main, fx)
+
+    sender = asyncio.create_task(main.DISPATCHER.run(bot))
+    lag = LoopLag()
+    lag.start()
+
+    # 실제 알람 루프와 같은 경로: 박자마다 poll_tick → 도래한 그룹만 조회/평가
+    interval = main.ALARM_TICK_SEC if args.tick_interval is None else args.tick_interval
+    ticks, requests, groups = [], [], []
+    for _ in range(args.ticks):
+        fresh_tick(main)
+        groups.append(len(main.POLL_SCHED.due(time.time())))
+        before = fx.total()
+        t = time.perf_counter()
+        await main.poll_tick(None)
+        ticks.append(time.perf_counter() - t)
+        requests.append(fx.total() - before)
+        if interval:
+            await asyncio.sleep(interval)
+
+    await asyncio.sleep(args.drain)
+    loop_lag = lag.stop()
+    sender.cancel()
+
+    st = main.DISPATCHER.stats()
+    return {
+        "tick_ms": summarize(ticks),
+        "requests_per_tick": {"mean": sum(requests) / len(requests), "max": max(requests)},
+        "groups_per_tick": {"mean": sum(groups) / len(groups), "max": max(groups)},
+        "messages_sent": len(tg.sent),
+        "messages_queued": st["depth"],
+        "alarms_delivered": st["sent"] + st["coalesced"],
+        "send_latency_p95_s": round(st["latency_p95"], 3),
+        "loop_lag_ms": loop_lag,
+    }
+
+async def scenario_gap_auto(args, main, fx, tg, bot, ws):
+    rng = random.Random(args.seed)
+    main.save_gap_auto({
+        str(2000 + i): {
+            "threshold": round(rng.uniform(0.2, 2.0), 2),
+            "interval_min": rng.choice([1, 10, 30]),
+            "enabled": True,
+            "next_run": 0,
+        }
+        for i in range(args.subs)
+    })
+
+    sender = asyncio.create_task(main.DISPATCHER.run(bot))
+    lag = LoopLag()
+    lag.start()
+
+    before = fx.total()
+    t = time.perf_counter()
+    loop = asyncio.create_task(main.gap_auto_loop())
+    while any(cfg["next_run"] == 0 for cfg in main.load_gap_auto().values()):
+        await asyncio.sleep(0.01)
+    cycle = time.perf_counter() - t
+    requests = fx.total() - before
+
+    await asyncio.sleep(args.drain)
+    loop_lag = lag.stop()
+    loop.cancel()
+    sender.cancel()
+
+    st = main.DISPATCHER.stats()
+    return {
+        "cycle_ms": round(cycle * 1000, 3),
+        "requests_per_cycle": requests,
+        "requests_by_path": dict(fx.counts),
+        "messages_sent": len(tg.sent),
+        "messages_queued": st["depth"],
+        "loop_lag_ms": loop_lag,
+    }
+
+async def scenario_status_burst(args, main, fx, tg, bot, ws):
+    rng = random.Random(args.seed)
+    coins = fx.coins[:args.burst_coins]
+    updates = [
+        fake_update(bot, i, 3000 + i, f"/status {rng.choice(coins)}")
+        for i in range(args.concurrency)
+    ]
+
+    async def one(u):
+        t = time.perf_counter()
+        ctx = SimpleNamespace(args=u.message.text.split()[1:])
+        await main.status_cmd(u, ctx)
+        return time.perf_counter() - t
+
+    lag = LoopLag()
+    lag.start()
+    before, sent_before = fx.total(), len(tg.sent)
+    t = time.perf_counter()
+    latencies = await asyncio.gather(*(one(u) for u in updates))
+    wall = time.perf_counter() - t
+    loop_lag = lag.stop()
+
+    return {
+        "command_ms": summarize(latencies),
+        "wall_ms": round(wall * 1000, 3),
+        "requests": fx.total() - before,
+        "requests_by_path": dict(fx.counts),
+        "messages_sent": len(tg.sent) - sent_before,
+        "loop_lag_ms": loop_lag,
+    }
+
+async def wait_until(cond, timeout=30):
+    end = time.perf_counter() + timeout
+    while not cond():
+        if time.perf_counter() > end:
+            raise TimeoutError("조건 대기 시간 초과")
+        await asyncio.sleep(0.01)
+
+async def scenario_stream(args, main, fx, tg, bot, ws):
+    seed_alarms(args, main, fx)
+    main.STREAM_MODE = True
+
+    sender = asyncio.create_task(main.DISPATCHER.run(bot))
+    lag = LoopLag()
+    lag.start()
+
+    before = fx.total()
+    t = time.perf_counter()
+    streams = [asyncio.create_task(main.price_stream(None, ex)) for ex in main.STREAM_WS_URLS]
+    await wait_until(main.stream_alive)
+    connect = time.perf_counter() - t
+
+    # 중간에 한 번 끊어서 재연결(+재구독) 시간 측정
+    await asyncio.sleep(args.duration / 2)
+    await ws.drop()
+    t = time.perf_counter()
+    await wait_until(lambda: not main.stream_alive())
+    await wait_until(main.stream_alive)
+    reconnect = time.perf_counter() - t
+    await asyncio.sleep(args.duration / 2)
+
+    for task in streams:
+        task.cancel()
+    await asyncio.sleep(args.drain)
+    loop_lag = lag.stop()
+    sender.cancel()
+
+    st = main.DISPATCHER.stats()
+    return {
+        "connect_ms": round(connect * 1000, 3),
+        "reconnect_ms": round(reconnect * 1000, 3),
+        "ticks_pushed": dict(ws.pushed),
+        "connects": dict(ws.connects),
+        "rest_requests": fx.total() - before,
+        "coins_evaluated": len(main._STREAM_LAST_EVAL),
+        "messages_sent": len(tg.sent),
+        "alarms_delivered": st["sent"] + st["coalesced"],
+        "send_latency_p95_s": round(st["latency_p95"], 3),
+        "loop_lag_ms": loop_lag,
+    }
+
+async def run(args):
+    main, fx, tg, bot, ws = await setup(args)
+    fn = globals()[f"scenario_{args.scenario}"]
+    try:
+        metrics = await fn(args, main, fx, tg, bot, ws)
+    finally:
+        await main.close_http()
+        await bot.shutdown()
+        await fx.stop()
+        await tg.stop()
+        await ws.stop()
+
+    result = {
+        "scenario": args.scenario,
+        "git_rev": git_rev(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("scenario", "out")},
+        "metrics": metrics,
+    }
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"{args.scenario}-{result['git_rev']}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+    print(f"→ {out}")
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.run")
+    p.add_argument("scenario", choices=SCENARIOS + ("all",))
+    p.add_argument("--alarms", type=int, default=10000)
+    p.add_argument("--chats", type=int, default=500)
+    p.add_argument("--coins", type=int, default=200, help="가짜 거래소 마켓 크기")
+    p.add_argument("--ticks", type=int, default=20)
+    p.add_argument("--tick-interval", type=float, default=None, help="틱 간격(초), 기본 main.ALARM_TICK_SEC")
+    p.add_argument("--subs", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=100)
+    p.add_argument("--burst-coins", type=int, default=5, help="/status 몰림 시 코인 종류 수")
+    p.add_argument("--latency", type=float, default=0.02, help="거래소 응답 지연(초)")
+    p.add_argument("--jitter", type=float, default=0.01)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--tg-latency", type=float, default=0.01)
+    p.add_argument("--duration", type=float, default=5.0, help="스트림 측정 시간(초)")
+    p.add_argument("--ws-interval", type=float, default=0.2, help="가짜 WS 체결 푸시 간격(초)")
+    p.add_argument("--drain", type=float, default=1.0, help="측정 후 발송 큐 비우는 시간(초)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.scenario == "all":
+        # 시나리오마다 새 프로세스 (main 전역 상태 분리)
+        rest = sys.argv[2:]
+        for name in SCENARIOS:
+            subprocess.run([sys.executable, "-m", "bench.run", name] + rest, check=True)
+    else:
+        asyncio.run(run(args))
@@ -0,0 +1,85 @@
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qs
+
+#################################
+# 최소 HTTP/1.1 서버 (keep-alive 지원, 벤치마크 가짜 서버 공용)
+#################################
+
+REASONS = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+class StubServer:
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.counts = {}  # 경로 → 요청 수
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def total(self):
+        return sum(self.counts.values())
+
+    async def route(self, method, path, query, body):
+        # → (status, 응답 객체)
+        return 404, {"error": "not found"}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = h.decode().split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                body = b""
+                if int(headers.get("content-length", 0)):
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                parts = urlsplit(target)
+                query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+                self.counts[parts.path] = self.counts.get(parts.path, 0) + 1
+
+                status, payload = await self.route(method, parts.path, query, (headers, body))
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+def parse_body(req):
+    # PTB는 form 인코딩 / JSON 둘 다 씀
+    headers, body = req
+    if not body:
+        return {}
+    if "json" in headers.get("content-type", ""):
+        return json.loads(body)
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
@@ -1,12 +1,29 @@
 import os
 import json
-import requests
+import signal
+import sqlite3
+import subprocess
+import sys
+import httpx
 import asyncio
+import bisect
+import heapq
+import hmac
 import jwt
+import math
+import mmap
+import numpy as np
+import secrets
+import struct
+import threading
 import uuid
+import websockets
+import zlib
 import time as _time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from telegram import Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
 #################################
@@ -14,32 +31,141 @@ from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 #################################
 
 TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # 테스트용 가짜 Bot API 주소
+
+# 웹훅 모드: 업데이트를 HTTP로 받음 (WEBHOOK_URL 없으면 등록 없이 로컬 서버만 → 가짜 업데이트 POST 로 테스트)
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE") == "1"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # 외부에서 닿는 주소 (https://...)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token 검증 (WEBHOOK_URL 있고 비어 있으면 무작위 생성)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))  # 동시에 처리할 업데이트 수
+WEBHOOK_MAX_BODY = 1 << 20
+WEBHOOK_READ_TIMEOUT = float(os.getenv("WEBHOOK_READ_TIMEOUT", "30"))  # 요청 하나 (keep-alive 대기 포함) 읽기 제한
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES") == "1"  # 재시작 중 밀린 명령 버릴지
 UPBIT_ACCESS = os.getenv("UPBIT_ACCESS")
 UPBIT_SECRET = os.getenv("UPBIT_SECRET")
 FIXIE_URL = os.getenv("FIXIE_URL")
-PROXIES = {"http": FIXIE_URL, "https": FIXIE_URL} if FIXIE_URL else {}
+PROXIES = {"http://": FIXIE_URL, "https://": FIXIE_URL} if FIXIE_URL else None
 
-ALARM_FILE = "/app/data/alarms.json"
-NIGHT_FILE = "/app/data/night_mode.json"
-GAP_AUTO_FILE = "/app/data/gap_auto.json"
+UPBIT_API = os.getenv("UPBIT_API_URL", "https://api.upbit.com")
+BITHUMB_API = os.getenv("BITHUMB_API_URL", "https://api.bithumb.com")
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "10"))  # 호스트별 동시 요청 수
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "30"))
+
+# 거래소별 차단기: 연속 실패 N회면 열고, 백오프 후 한 번만 시험 요청
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_BACKOFF_SEC = float(os.getenv("CIRCUIT_BACKOFF_SEC", "5"))
+CIRCUIT_BACKOFF_MAX = float(os.getenv("CIRCUIT_BACKOFF_MAX", "300"))
+STALE_MAX_SEC = float(os.getenv("STALE_MAX_SEC", "600"))  # 장애 시 이 시간 이내 가격까지는 '지연' 표시 후 보여줌
+
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
+DB_FILE = f"{DATA_DIR}/bot.db"
+
+# 예전 JSON 저장 파일 (최초 1회 DB로 이전)
+ALARM_FILE = f"{DATA_DIR}/alarms.json"
+NIGHT_FILE = f"{DATA_DIR}/night_mode.json"
+GAP_AUTO_FILE = f"{DATA_DIR}/gap_auto.json"
 
 CHECK_INTERVAL = 5
-COOLDOWN_SEC = 300  # 5분 쿨다운
 
-NIGHT_START = 23
-NIGHT_END = 7
+# 적응형 폴링: 임계값에 가까운/변동 큰 그룹은 자주, 먼 그룹은 드물게
+ALARM_TICK_SEC = float(os.getenv("ALARM_TICK_SEC", "0.5"))   # 스케줄러 박자 = 핫 티어 주기
+ALARM_COLD_SEC = float(os.getenv("ALARM_COLD_SEC", "45"))    # 콜드 티어 최대 주기
+ALARM_HORIZON = 4      # 예상 도달시간의 1/4 지점에서 다시 확인
+ALARM_VOL_ALPHA = 0.3  # 변동성 EWMA 가중치
+ALARM_VOL_FLOOR = 1e-6  # 초당 상대 괴리 변화 하한 (0으로 나누기 방지)
+COOLDOWN_SEC = 300  # 5분 쿨다운
 
-EXCHANGE_MAP = {
-    "업비트": "upbit",
-    "빗썸": "bithumb",
+# 실행 역할: all(기본, 한 프로세스) / cluster(아래 역할들을 한 호스트에 띄움)
+#           fetcher(시세 조회+버스 브로커) / evaluator(샤드별 알람 평가) / sender(텔레그램 명령·발송)
+ROLE = os.getenv("ROLE", "all")
+EVALUATORS = int(os.getenv("EVALUATORS", "2"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # evaluator 수 (chat_id 해시로 나눔)
+BUS_SOCKET = os.getenv("BUS_SOCKET", "/tmp/telegram-bot-bus.sock")
+BUS_BACKLOG = 10000          # 브로커 연결 끊긴 동안 쌓아둘 메시지 수
+BUS_MAX_BUFFER = 4 * 2**20   # 구독자별 쓰기 버퍼 한도 (넘으면 버림)
+BUS_LINE_LIMIT = 64 * 2**20  # 한 줄(메시지) 최대 크기 (기본 64KiB면 큰 스냅샷에서 끊김)
+
+STREAM_MODE = os.getenv("STREAM_MODE") == "1"
+UPBIT_WS_URL = os.getenv("UPBIT_WS_URL", "wss://api.upbit.com/websocket/v1")
+BITHUMB_WS_URL = os.getenv("BITHUMB_WS_URL", "wss://pubwss.bithumb.com/pub/ws")
+STREAM_WS_URLS = {"upbit": UPBIT_WS_URL, "bithumb": BITHUMB_WS_URL}  # 스트림 지원 거래소
+STREAM_EVAL_MIN_SEC = 1.0  # 코인별 최소 평가 간격
+
+# 가격 캐시: 거래소별 기본 TTL(초) + 최대 항목 수
+PRICE_TTL = {
+    "upbit": float(os.getenv("PRICE_TTL_UPBIT", "2")),
+    "bithumb": float(os.getenv("PRICE_TTL_BITHUMB", "2")),
 }
+PRICE_CACHE_MAX = int(os.getenv("PRICE_CACHE_MAX", "5000"))
+
+# 호출부별 허용 지연(초)
+STATUS_MAX_AGE = 2
+SET_MAX_AGE = 2
+GAP_MAX_AGE = 2
+ALARM_MAX_AGE = CHECK_INTERVAL  # 알람 루프는 한 틱까지 허용
+
+# /gap size=금액 → |괴리율| 상위 코인만 호가 조회해서 실제 체결 기준 괴리 계산
+ORDERBOOK_TOP_N = int(os.getenv("ORDERBOOK_TOP_N", "10"))
+ORDERBOOK_MAX_AGE = float(os.getenv("ORDERBOOK_MAX_AGE", "3"))
+
+# 입출금 상태 캐시
+WALLET_TTL = float(os.getenv("WALLET_TTL", "120"))
+WALLET_REFRESH_SEC = float(os.getenv("WALLET_REFRESH_SEC", "60"))
+
+GAP_AUTO_BATCH_SEC = 5  # 이 안에 도래한 자동 gap 구독은 같은 시세로 묶어서 처리
+GAP_AUTO_DIFF = os.getenv("GAP_AUTO_DIFF", "1") == "1"  # 자동 gap은 지난번과 달라진 것만 발송
+GAP_AUTO_MOVE = float(os.getenv("GAP_AUTO_MOVE", "0.3"))  # 괴리율이 이만큼(%p) 움직이면 변화로 봄
+
+# 지표: METRICS_PORT 설정 시 로컬 Prometheus 엔드포인트, /metrics 는 관리자만
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+ADMIN_CHAT_IDS = {int(x) for x in os.getenv("ADMIN_CHAT_IDS", "").split(",") if x.strip()}
+
+# 텔레그램 발송 한도 (전체 ~30/s, 채팅당 ~1/s)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_MAX_RETRY = 3           # 연결 오류만 재시도 (응답 시간 초과는 이미 전달됐을 수 있어 재시도 안 함)
+SEND_BUCKET_PRUNE_SEC = 60   # 한동안 안 쓴 채팅별 한도 버킷 정리 주기
+MAX_MESSAGE_LEN = 4096
 
-FEE_RATE = {
-    "upbit": 0.0005,
-    "bithumb": 0.0004
-}
+NIGHT_START = 23
+NIGHT_END = 7
 
-ALERT_STATE = {}
+# 거래소 어댑터 등록 시 채워짐 (register_exchange)
+EXCHANGE_MAP = {}   # 한글 이름 → 거래소 키
+EXCHANGE_NAME = {}  # 거래소 키 → 한글 이름
+FEE_RATE = {}
+
+DEFAULT_GAP_PAIR = ("upbit", "bithumb")  # /gap 에서 거래소를 안 적었을 때
+
+# 상장 목록: 한 달에 몇 번 바뀌는 데이터 → 길게 캐시 + 백그라운드 갱신
+MARKET_TTL = float(os.getenv("MARKET_TTL", str(6 * 3600)))
+MARKET_REFRESH_SEC = float(os.getenv("MARKET_REFRESH_SEC", "600"))
+LISTING_NOTIFY = os.getenv("LISTING_NOTIFY") == "1"  # 양쪽 상장되면 자동 gap 구독자에게 알림
+
+# 시세 기록: 틱마다 코인별 양쪽 가격/괴리율 + 1분/1시간 롤업 (일자별 파일, 보관 기간 지나면 삭제)
+HISTORY_DIR = f"{DATA_DIR}/history"
+HISTORY_TICK_SEC = float(os.getenv("HISTORY_TICK_SEC", "5"))
+# 기록하는 거래소쌍 (기본 /gap 쌍). 파일에는 거래소 이름이 없음 → 바꾸면 예전 기록과 섞임
+HISTORY_PAIR = DEFAULT_GAP_PAIR
+HISTORY_PAIR_SKEW = CHECK_INTERVAL  # 양쪽 가격 조회시각 차이가 이 이내일 때만 기록
+HISTORY_RAW_DAYS = int(os.getenv("HISTORY_RAW_DAYS", "3"))
+HISTORY_1M_DAYS = int(os.getenv("HISTORY_1M_DAYS", "14"))
+HISTORY_1H_DAYS = int(os.getenv("HISTORY_1H_DAYS", "365"))
+HISTORY_OPEN_SEGMENTS = 32
+
+# 알람 상태(쿨다운/횟수) 보관
+ALERT_IDLE_SEC = 6 * 3600  # 이 시간 동안 평가 안 된 상태는 정리
+ALERT_SAVE_SEC = 30        # 변경 있으면 이 주기로 DB 스냅샷
 
 #################################
 # 가격 포맷 함수 (소수점 자동 조정)
@@ -54,214 +180,1290 @@ def fmt(n):
         return f"{n:,.4f}"
 
 #################################
-# 저장
+# 저장 (SQLite WAL + 메모리 캐시)
 #################################
 
+_DB = None
+_MEM = {}  # 테이블 → 메모리 사본 (읽기는 여기서만)
+
 def ensure_data_dir():
-    os.makedirs("/app/data", exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+def db():
+    global _DB
+    if _DB is None:
+        ensure_data_dir()
+        conn = sqlite3.connect(DB_FILE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS alarms ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT UNIQUE NOT NULL, chat_id INTEGER NOT NULL, data TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS alarms_chat ON alarms(chat_id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS night ("
+                "chat_id TEXT PRIMARY KEY, enabled INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gap_auto ("
+                "chat_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS alert_state ("
+                "id TEXT PRIMARY KEY, last_sent REAL, count INTEGER, last_seen REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value TEXT)"
+            )
+        _DB = conn
+        migrate_json()
+    return _DB
 
-def load_alarms():
+def _read_json(path, default):
     try:
-        with open(ALARM_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     except:
-        return []
+        return default
 
-def save_alarms(data):
-    ensure_data_dir()
-    with open(ALARM_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def migrate_json():
+    # 예전 JSON 파일 → DB (한 번만). 원본 파일은 그대로 둠
+    conn = _DB
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
 
-def load_night():
-    try:
-        with open(NIGHT_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return {}
+    alarms = _read_json(ALARM_FILE, [])
+    night = _read_json(NIGHT_FILE, {})
+    gap_auto = _read_json(GAP_AUTO_FILE, {})
 
-def save_night(data):
-    ensure_data_dir()
-    with open(NIGHT_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with conn:
+        for a in alarms:
+            a.setdefault("id", new_alarm_id())
+            conn.execute(
+                "INSERT OR IGNORE INTO alarms (id, chat_id, data) VALUES (?, ?, ?)",
+                (a["id"], a["chat_id"], json.dumps(a, ensure_ascii=False))
+            )
+        for cid, on in night.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO night (chat_id, enabled) VALUES (?, ?)",
+                (str(cid), 1 if on else 0)
+            )
+        for cid, cfg in gap_auto.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO gap_auto (chat_id, data) VALUES (?, ?)",
+                (str(cid), json.dumps(cfg))
+            )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(_time.time()),))
+
+    if alarms or night or gap_auto:
+        print(f"[저장소 이전] JSON → SQLite 알람 {len(alarms)}개, 밤모드 {len(night)}개, 자동gap {len(gap_auto)}개")
+
+def _mem(table):
+    cache = _MEM.get(table)
+    if cache is None:
+        conn = db()
+        if table == "alarms":
+            rows = conn.execute("SELECT id, data FROM alarms ORDER BY seq")
+            cache = {aid: json.loads(data) for aid, data in rows}
+        elif table == "night":
+            rows = conn.execute("SELECT chat_id, enabled FROM night")
+            cache = {cid: bool(on) for cid, on in rows}
+        else:
+            rows = conn.execute("SELECT chat_id, data FROM gap_auto")
+            cache = {cid: json.loads(data) for cid, data in rows}
+        _MEM[table] = cache
+    return cache
 
-def load_gap_auto():
-    try:
-        with open(GAP_AUTO_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return {}
+def load_alarms():
+    # nan/inf 임계값은 정렬 목록을 깨뜨림 → 예전에 저장된 것도 건너뜀
+    return [a for a in _mem("alarms").values() if math.isfinite(a["diff"])]
+
+def add_alarm(a):
+    conn = db()
+    with conn:
+        conn.execute(
+            "INSERT INTO alarms (id, chat_id, data) VALUES (?, ?, ?)",
+            (a["id"], a["chat_id"], json.dumps(a, ensure_ascii=False))
+        )
+    _mem("alarms")[a["id"]] = a
+
+def remove_alarm(alarm_id):
+    conn = db()
+    with conn:
+        conn.execute("DELETE FROM alarms WHERE id = ?", (alarm_id,))
+    return _mem("alarms").pop(alarm_id, None)
 
-def save_gap_auto(data):
-    ensure_data_dir()
-    with open(GAP_AUTO_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def load_night():
+    return dict(_mem("night"))
+
+def set_night(cid, on):
+    conn = db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO night (chat_id, enabled) VALUES (?, ?)",
+            (str(cid), 1 if on else 0)
+        )
+    _mem("night")[str(cid)] = on
+
+def load_alert_state():
+    return db().execute("SELECT id, last_sent, count, last_seen FROM alert_state").fetchall()
+
+def save_alert_state(rows, owned=None):
+    # 통째로 교체 (울린 알람만 있어서 작음)
+    # owned: 샤드 evaluator가 맡은 알람id → 그 행만 교체 (다른 샤드 행은 둠)
+    conn = db()
+    with conn:
+        if owned is None:
+            conn.execute("DELETE FROM alert_state")
+        else:
+            conn.executemany("DELETE FROM alert_state WHERE id = ?", [(aid,) for aid in owned])
+        conn.executemany(
+            "INSERT INTO alert_state (id, last_sent, count, last_seen) VALUES (?, ?, ?, ?)",
+            rows
+        )
+
+def load_gap_auto():
+    return {cid: dict(cfg) for cid, cfg in _mem("gap_auto").items()}
+
+def save_gap_auto(updates):
+    # updates: {chat_id: 설정} — 여러 건도 한 트랜잭션으로
+    conn = db()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO gap_auto (chat_id, data) VALUES (?, ?)",
+            [(str(cid), json.dumps(cfg)) for cid, cfg in updates.items()]
+        )
+    cache = _mem("gap_auto")
+    for cid, cfg in updates.items():
+        cache[str(cid)] = dict(cfg)
 
 #################################
 # 🇰🇷 한국시간 기준 밤 체크
 #################################
 
-def is_night_time():
-    kst = datetime.utcnow() + timedelta(hours=9)
-    h = kst.hour
-    return h >= NIGHT_START or h < NIGHT_END
+def is_night_time(now=None):
+    # now: 유닉스 시각 (리플레이의 가상 시계, numpy 배열이면 틱별로), 없으면 현재
+    if now is None:
+        now = _time.time()
+    h = (now + 9 * 3600) // 3600 % 24
+    return (h >= NIGHT_START) | (h < NIGHT_END)
 
 #################################
-# 안전한 가격 조회 (0원 차단 + status 체크)
+# 📈 지표 수집 (Prometheus 텍스트 + /metrics)
 #################################
 
-def get_price(exchange, coin):
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}    # (이름, 라벨) → 값
+        self.gauges = {}
+        self.hists = {}       # (이름, 라벨) → [버킷별 개수..., 합, 개수]
+        self.buckets = {}     # 이름 → 버킷 경계
+        self.help = {}
+        self.collectors = []  # 출력 직전에 게이지 채우는 함수들
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        self.gauges[(name, tuple(labels))] = value
+
+    def set_total(self, name, value, labels=()):
+        # 다른 곳에서 누적 중인 값을 카운터로 노출
+        self.counters[(name, tuple(labels))] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, tuple(labels))
+        h = self.hists.get(key)
+        if h is None:
+            self.buckets[name] = buckets
+            h = self.hists[key] = [0] * len(buckets) + [0.0, 0]
+        i = bisect.bisect_left(buckets, value)
+        if i < len(buckets):
+            h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    def quantile(self, name, q, labels=()):
+        # 버킷 경계 기준 근사값
+        h = self.hists.get((name, tuple(labels)))
+        if not h or not h[-1]:
+            return None
+        target = h[-1] * q
+        seen = 0
+        for bound, n in zip(self.buckets[name], h):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def series(self, name):
+        # → [(라벨, 개수, 합)] (히스토그램)
+        return [(k[1], h[-1], h[-2]) for k, h in self.hists.items() if k[0] == name]
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"[지표 수집 오류] {e}")
+
+        def lbl(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        out = []
+        typed = set()
+
+        def head(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in sorted(self.counters.items()):
+            head(name, "counter")
+            out.append(f"{name}{lbl(labels)} {v}")
+        for (name, labels), v in sorted(self.gauges.items()):
+            head(name, "gauge")
+            out.append(f"{name}{lbl(labels)} {v}")
+        for (name, labels), h in sorted(self.hists.items()):
+            head(name, "histogram")
+            cum = 0
+            for bound, n in zip(self.buckets[name], h):
+                cum += n
+                out.append(f"{name}_bucket{lbl(labels, [('le', bound)])} {cum}")
+            out.append(f"{name}_bucket{lbl(labels, [('le', '+Inf')])} {h[-1]}")
+            out.append(f"{name}_sum{lbl(labels)} {h[-2]}")
+            out.append(f"{name}_count{lbl(labels)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("exchange_request_seconds", "거래소 API 응답 시간")
+METRICS.describe("exchange_request_errors_total", "거래소 API 오류 수")
+METRICS.describe("exchange_circuit_opens_total", "거래소 차단기 열린 횟수")
+METRICS.describe("exchange_circuit_state", "거래소 차단기 상태 (0 닫힘, 1 시험중, 2 열림)")
+METRICS.describe("alarm_tick_seconds", "알람 루프 1틱 소요 시간")
+METRICS.describe("alarm_tick_overruns_total", "밀려서 건너뛴 스케줄러 박자 수")
+METRICS.describe("gap_auto_lag_seconds", "자동 gap 예정 시각 대비 실제 실행 지연")
+METRICS.describe("event_loop_lag_seconds", "이벤트 루프 지연")
+METRICS.describe("history_ticks_total", "시세 기록에 쌓인 코인별 틱 수")
+METRICS.describe("gap_auto_diff_total", "자동 gap 변화분만 발송한 횟수")
+METRICS.describe("gap_auto_suppressed_total", "자동 gap 변화 없어서 발송 생략한 횟수")
+METRICS.describe("singleflight_shared_total", "진행 중인 요청에 합류한 횟수 (새 요청 생략)")
+METRICS.describe("orderbook_snapshots_total", "호가 일괄 조회 횟수 (거래소쌍별)")
+METRICS.describe("market_listing_changes_total", "상장 목록 변경 감지 횟수")
+METRICS.describe("webhook_updates_total", "웹훅으로 받은 업데이트 수")
+METRICS.describe("webhook_rejected_total", "비밀 토큰이 틀려 거절한 웹훅 요청 수")
+METRICS.describe("bus_snapshots_total", "fetcher가 발행한 가격 스냅샷 수")
+METRICS.describe("bus_snapshot_delay_seconds", "스냅샷 발행 → evaluator 수신 지연")
+METRICS.describe("bus_dropped_total", "구독자 버퍼가 차서 버린 버스 메시지 수")
+
+def _endpoint_label(url, exchange=None):
+    # 코인별 경로는 묶어서 라벨 수 폭증 방지
+    u = httpx.URL(url)
+    exchange = exchange or u.host
+    parts = u.path.split("/")
+    if exchange == "bithumb" and len(parts) >= 4 and parts[-1] not in ("ALL", "ALL_KRW"):
+        parts[-1] = "{coin}"
+    return exchange, "/".join(parts)
+
+async def loop_lag_monitor(interval=0.5):
+    while True:
+        t = _time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0, _time.monotonic() - t - interval)
+        METRICS.set("event_loop_lag_seconds_last", lag)
+        METRICS.observe("event_loop_lag_seconds", lag)
+
+async def _metrics_http(reader, writer):
     try:
-        if exchange == "upbit":
-            r = requests.get(
-                f"https://api.upbit.com/v1/ticker?markets=KRW-{coin}",
-                timeout=3
-            )
-            data = r.json()
-            if not data:
-                return None
-            price = float(data[0]["trade_price"])
+        line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = line.decode().split(" ")[1] if line else ""
+        if path.split("?")[0] == "/metrics":
+            body = METRICS.render().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"[지표 서버 오류] {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    server = await asyncio.start_server(_metrics_http, METRICS_HOST, METRICS_PORT)
+    print(f"[지표 서버] http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+#################################
+# 🚧 거래소 차단기 (circuit breaker)
+#################################
+
+class CircuitOpen(Exception):
+    pass
+
+class Circuit:
+    # closed → (연속 실패) → open → (백오프 경과) → half_open 시험 1회 → closed / open(백오프 2배)
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = CIRCUIT_BACKOFF_SEC
+        self.opened_at = 0
+        self.probing = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if _time.monotonic() - self.opened_at < self.backoff:
+                return False
+            self.state = "half_open"
+            self.probing = False
+        # half_open: 시험 요청은 한 번에 하나만
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def retry_in(self):
+        if self.state != "open":
+            return 0
+        return max(0, self.backoff - (_time.monotonic() - self.opened_at))
+
+    def success(self):
+        if self.state != "closed":
+            print(f"[차단기 복구] {self.name}")
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = CIRCUIT_BACKOFF_SEC
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open":
+            self.backoff = min(self.backoff * 2, CIRCUIT_BACKOFF_MAX)
+        elif self.state == "closed" and self.failures < CIRCUIT_FAILURES:
+            return
+        elif self.state == "open":
+            return
+        self.state = "open"
+        self.opened_at = _time.monotonic()
+        self.probing = False
+        METRICS.inc("exchange_circuit_opens_total", [("exchange", self.name)])
+        print(f"[차단기 열림] {self.name} → {self.backoff:.0f}초 후 재시도 (연속 실패 {self.failures})")
 
-        elif exchange == "bithumb":
-            r = requests.get(
-                f"https://api.bithumb.com/public/ticker/{coin}_KRW",
-                timeout=3
+CIRCUITS = {}
+
+def circuit(name):
+    c = CIRCUITS.get(name)
+    if c is None:
+        c = CIRCUITS[name] = Circuit(name)
+    return c
+
+def circuit_open(exchange):
+    c = CIRCUITS.get(exchange)
+    return c is not None and c.state != "closed"
+
+#################################
+# 🌐 비동기 HTTP 클라이언트 (커넥션 풀 공유)
+#################################
+
+_HTTP = {}
+_HOST_SEM = {}
+
+def _http_client(proxy=False):
+    key = "proxy" if proxy else "direct"
+    client = _HTTP.get(key)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_SEC,
+            ),
+            timeout=HTTP_TIMEOUT,
+            proxies=PROXIES if proxy else None,
+        )
+        _HTTP[key] = client
+    return client
+
+async def http_get_json(url, params=None, headers=None, timeout=None, proxy=False, exchange=None):
+    # 호스트별 동시 요청 수 제한 + keep-alive 커넥션 재사용
+    host = httpx.URL(url).host
+    sem = _HOST_SEM.get(host)
+    if sem is None:
+        sem = _HOST_SEM[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+
+    exchange, endpoint = _endpoint_label(url, exchange)
+    via = "fixie" if proxy and PROXIES else "direct"
+
+    # 프록시 경유는 프록시 장애가 시세 조회까지 막지 않도록 따로 셈
+    cb = circuit(exchange if via == "direct" else f"{exchange}_{via}")
+    if not cb.allow():
+        METRICS.inc("exchange_request_errors_total", [("exchange", exchange), ("endpoint", endpoint), ("kind", "circuit_open")])
+        raise CircuitOpen(cb.name)
+
+    async with sem:
+        t = _time.monotonic()
+        try:
+            r = await _http_client(proxy).get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=timeout or HTTP_TIMEOUT
             )
-            data = r.json()
+        except asyncio.CancelledError:
+            cb.probing = False  # 시험 요청이 취소되면 다음 요청이 다시 시험
+            raise
+        except Exception as e:
+            cb.failure()
+            METRICS.inc("exchange_request_errors_total", [("exchange", exchange), ("endpoint", endpoint), ("kind", type(e).__name__)])
+            raise
+        finally:
+            METRICS.observe("exchange_request_seconds", _time.monotonic() - t, [("exchange", exchange), ("endpoint", endpoint), ("via", via)])
+
+    # 4xx(없는 마켓 등)는 요청 문제 → 거래소 장애로 보지 않음
+    if r.status_code >= 500 or r.status_code == 429:
+        cb.failure()
+    else:
+        cb.success()
+    if r.status_code >= 400:
+        METRICS.inc("exchange_request_errors_total", [("exchange", exchange), ("endpoint", endpoint), ("kind", f"http_{r.status_code}")])
+    return r.json()
 
-            if data.get("status") != "0000":
-                return None
+async def close_http():
+    for client in _HTTP.values():
+        await client.aclose()
+    _HTTP.clear()
 
-            price = float(data["data"]["closing_price"])
+#################################
+# 🗃 공유 가격 캐시 (TTL + 크기 제한)
+#################################
 
-        else:
+class PriceCache:
+    # (거래소, 코인) → (가격, 조회시각). 오래된 항목부터 밀어냄
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.full = {}  # 거래소 → (전체시세 조회시각, 코인목록)
+        self.dirty = set()  # 지난 기록 틱 이후 가격이 들어온 코인 (시세 기록용)
+
+    def _max_age(self, exchange, max_age):
+        return self.ttl.get(exchange, 0) if max_age is None else max_age
+
+    def put(self, exchange, coin, price, ts=None):
+        key = (exchange, coin)
+        self.entries[key] = (price, ts or _time.time())
+        self.entries.move_to_end(key)
+        self.dirty.add(coin)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put_many(self, exchange, prices, ts=None, full=False):
+        ts = ts or _time.time()
+        for coin, price in prices.items():
+            self.put(exchange, coin, price, ts)
+        if full:
+            self.full[exchange] = (ts, tuple(prices))
+
+    def get(self, exchange, coin, max_age=None):
+        # 허용 지연 이내면 (가격, 조회시각), 아니면 None
+        entry = self.entries.get((exchange, coin))
+        if entry is None:
+            return None
+        if _time.time() - entry[1] > self._max_age(exchange, max_age):
             return None
+        return entry
 
-        if price <= 0:
+    def age(self, exchange, coin=None):
+        # 마지막 조회 후 지난 시간 (coin 없으면 전체 시세 기준), 기록 없으면 None
+        entry = self.entries.get((exchange, coin)) if coin else self.full.get(exchange)
+        if entry is None:
             return None
+        ts = entry[1] if coin else entry[0]
+        return _time.time() - ts
 
-        return price
+    def get_all(self, exchange, max_age=None):
+        # 전체 시세 조회 결과가 허용 지연 이내면 {코인: 가격}, 아니면 None
+        full = self.full.get(exchange)
+        if full is None or _time.time() - full[0] > self._max_age(exchange, max_age):
+            return None
+        prices = {}
+        for coin in full[1]:
+            entry = self.entries.get((exchange, coin))
+            if entry is None:
+                return None
+            prices[coin] = entry[0]
+        return prices
 
-    except:
-        return None
+PRICE_CACHE = PriceCache(PRICE_TTL, PRICE_CACHE_MAX)
 
 #################################
-# 📊 전체 코인 조회 (gap용)
+# 🔌 거래소 어댑터 (시세/입출금/수수료/심볼 표기)
 #################################
 
-def get_upbit_all():
-    try:
-        markets = requests.get(
-            "https://api.upbit.com/v1/market/all",
-            timeout=3
-        ).json()
+class ExchangeAdapter:
+    # 거래소별 차이는 여기에만 둠 → 새 거래소는 어댑터 하나 추가 + register_exchange
+    name = ""
+    label = ""             # /set, /gap 에 쓰는 한글 이름
+    api = ""
+    fee = 0.0
+    timeout = HTTP_TIMEOUT  # 어댑터 호출 1회 전체 제한 (내부 요청 여러 번 포함)
+    bulk_only = False       # 코인 몇 개만 필요해도 전체 시세 한 번이 더 싼 거래소
+    markets = None          # (bulk_only) 마지막 전체 시세 응답에 있던 마켓 (가격이 잠깐 0이어도 상장)
+
+    def normalize(self, symbol):
+        # "KRW-ETH" / "ETH_KRW" / "eth" → "ETH"
+        return symbol.upper().replace("KRW-", "").replace("_KRW", "")
+
+    async def get(self, path, **kwargs):
+        return await http_get_json(f"{self.api}{path}", exchange=self.name, **kwargs)
+
+    async def ticker(self, coin):
+        # → 가격, 없는 코인이면 None
+        prices = await self.tickers([coin])
+        return prices.get(coin)
+
+    async def tickers(self, coins=None):
+        # → {코인: 가격}, coins 없으면 KRW 마켓 전체. 실패하면 예외
+        raise NotImplementedError
+
+    async def listings(self):
+        # → 상장 코인 집합 (전용 API 없으면 전체 시세의 코인 목록)
+        return set(await self.tickers())
+
+    async def orderbooks(self, coins):
+        # → {코인: (매도호가, 매수호가)} 각각 [[가격, 수량], ...] numpy 배열, 최우선 호가부터
+        raise NotImplementedError
+
+    def has_wallets(self):
+        return False
+
+    async def wallets(self):
+        # → {코인: (입금, 출금)} 1=가능 0=불가
+        raise NotImplementedError
+
+class UpbitAdapter(ExchangeAdapter):
+    name = "upbit"
+    label = "업비트"
+    api = UPBIT_API
+    fee = 0.0005
+    timeout = 8  # 마켓 목록 + 시세 두 번 요청할 수 있음
+
+    # 업비트 wallet_state → (입금, 출금)
+    WALLET_STATE = {
+        "working": (1, 1),
+        "withdraw_only": (0, 1),
+        "deposit_only": (1, 0),
+        "paused": (0, 0),
+        "unsupported": (0, 0),
+    }
+
+    async def ticker(self, coin):
+        data = await self.get(f"/v1/ticker?markets=KRW-{coin}", timeout=3)
+        if not data or not isinstance(data, list):
+            return None
+        return float(data[0]["trade_price"])
+
+    async def markets(self):
+        data = await self.get("/v1/market/all", timeout=3)
+        return [m["market"] for m in data if m["market"].startswith("KRW-")]
+
+    async def listings(self):
+        return {self.normalize(m) for m in await self.markets()}
+
+    async def tickers(self, coins=None):
+        # 상장 목록은 캐시에서 (마켓 목록 요청 생략), 폐지된 코인은 미리 뺌
+        if coins is None:
+            coins = sorted(await MARKETS.get(self.name))
+        elif MARKETS.listed(self.name, coins[0]) is not None:
+            coins = [c for c in coins if MARKETS.listed(self.name, c)]
+        if not coins:
+            return {}
+        markets = [f"KRW-{c}" for c in coins]
+        data = await self.get("/v1/ticker", params={"markets": ",".join(markets)}, timeout=5)
+
+        # 상장폐지 등 잘못된 마켓이 하나라도 섞이면 업비트는 전체 요청을 거부함
+        # → 상장 목록이 바뀐 것 → 새로 받아서 상장된 마켓만 한 번 더 요청
+        if not isinstance(data, list):
+            await MARKETS.refresh(self.name)
+            markets = [m for m in markets if MARKETS.listed(self.name, self.normalize(m))]
+            if not markets:
+                return {}
+            data = await self.get("/v1/ticker", params={"markets": ",".join(markets)}, timeout=5)
 
-        krw = [m['market'] for m in markets if m['market'].startswith("KRW-")]
+        prices = {}
+        for d in data:
+            price = float(d["trade_price"])
+            if price > 0:
+                prices[self.normalize(d["market"])] = price
+        return prices
+
+    async def orderbooks(self, coins):
+        # 여러 마켓을 요청 한 번에
+        coins = [c for c in coins if MARKETS.listed(self.name, c) is not False]
+        if not coins:
+            return {}
+        data = await self.get(
+            "/v1/orderbook", params={"markets": ",".join(f"KRW-{c}" for c in coins)}, timeout=5
+        )
+        if not isinstance(data, list):
+            raise ValueError("orderbook rejected")
+
+        books = {}
+        for d in data:
+            units = d.get("orderbook_units") or []
+            if not units:
+                continue
+            asks = np.array([(u["ask_price"], u["ask_size"]) for u in units], dtype=np.float64)
+            bids = np.array([(u["bid_price"], u["bid_size"]) for u in units], dtype=np.float64)
+            books[self.normalize(d["market"])] = (asks, bids)
+        return books
+
+    def has_wallets(self):
+        return bool(UPBIT_ACCESS and UPBIT_SECRET)
 
-        tickers = requests.get(
-            "https://api.upbit.com/v1/ticker",
-            params={"markets": ",".join(krw)},
+    async def wallets(self):
+        # 인증 필요 + Fixie 프록시 경유 → 갱신 주기마다 한 번만 서명/요청
+        # nonce는 요청마다 달라야 해서 토큰 자체는 재사용 불가
+        payload = {
+            "access_key": UPBIT_ACCESS,
+            "nonce": str(uuid.uuid4())
+        }
+        token = jwt.encode(payload, UPBIT_SECRET, algorithm="HS256")
+        data = await self.get(
+            "/v1/status/wallet",
+            headers={"Authorization": f"Bearer {token}"},
+            proxy=True,
             timeout=5
-        ).json()
+        )
+        return {
+            item["currency"]: self.WALLET_STATE[item["wallet_state"]]
+            for item in data if item.get("wallet_state") in self.WALLET_STATE
+        }
+
+class BithumbAdapter(ExchangeAdapter):
+    name = "bithumb"
+    label = "빗썸"
+    api = BITHUMB_API
+    fee = 0.0004
+    timeout = 6
+    bulk_only = True  # ALL_KRW 한 번에 전체 시세
+
+    async def ticker(self, coin):
+        data = await self.get(f"/public/ticker/{coin}_KRW", timeout=3)
+        if data.get("status") != "0000":
+            return None
+        return float(data["data"]["closing_price"])
+
+    async def tickers(self, coins=None):
+        data = await self.get("/public/ticker/ALL_KRW", timeout=5)
+        if data.get("status") != "0000":
+            raise ValueError(f"status {data.get('status')}")
 
         prices = {}
-        for d in tickers:
-            price = float(d['trade_price'])
+        markets = set()
+        for coin, d in data["data"].items():
+            if coin == "date" or not isinstance(d, dict):
+                continue
+            markets.add(self.normalize(coin))
+            price = float(d["closing_price"])
             if price > 0:
-                prices[d['market'].replace("KRW-", "")] = price
+                prices[self.normalize(coin)] = price
+        self.markets = markets
 
+        if coins is not None:
+            prices = {c: prices[c] for c in coins if c in prices}
         return prices
 
-    except:
-        return {}
+    async def listings(self):
+        # 상장 여부는 응답에 마켓이 있는지로 판단 (가격 0 은 상장/폐지가 반복되는 것처럼 보임)
+        await self.tickers()
+        return self.markets
+
+    async def orderbooks(self, coins):
+        # 전체 코인 호가를 요청 한 번에 → 필요한 코인만 변환
+        data = await self.get("/public/orderbook/ALL_KRW", timeout=5)
+        if data.get("status") != "0000":
+            raise ValueError(f"status {data.get('status')}")
+
+        books = {}
+        for coin in coins:
+            d = data["data"].get(coin)
+            if not isinstance(d, dict) or not d.get("asks") or not d.get("bids"):
+                continue
+            asks = np.array([(o["price"], o["quantity"]) for o in d["asks"]], dtype=np.float64)
+            bids = np.array([(o["price"], o["quantity"]) for o in d["bids"]], dtype=np.float64)
+            books[coin] = (asks, bids)
+        return books
+
+    def has_wallets(self):
+        return True
+
+    async def wallets(self):
+        data = await self.get("/public/assetsstatus/ALL", timeout=5)
+        if data["status"] != "0000":
+            raise ValueError(f"status {data['status']}")
 
-def get_bithumb_all():
+        table = {}
+        for coin, d in data["data"].items():
+            try:
+                table[self.normalize(coin)] = (int(d["deposit_status"]), int(d["withdrawal_status"]))
+            except:
+                continue
+        return table
+
+EXCHANGES = {}  # 거래소 키 → 어댑터 (등록 순서 = 화면 표시 순서)
+
+def register_exchange(adapter):
+    EXCHANGES[adapter.name] = adapter
+    EXCHANGE_MAP[adapter.label] = adapter.name
+    EXCHANGE_NAME[adapter.name] = adapter.label
+    FEE_RATE[adapter.name] = adapter.fee
+
+register_exchange(UpbitAdapter())
+register_exchange(BithumbAdapter())
+
+def resolve_exchange(text):
+    # "업비트" / "upbit" → "upbit", 모르는 이름이면 None
+    text = text.strip()
+    if text.lower() in EXCHANGES:
+        return text.lower()
+    return EXCHANGE_MAP.get(text)
+
+#################################
+# 🏷 상장 목록 캐시 (긴 TTL + 백그라운드 갱신, 바뀐 것만 반영)
+#################################
+
+class MarketCache:
+    # 거래소 → 상장 코인 집합. 바뀔 때만 version 이 올라감 → 하위 인덱스는 version 비교로 재계산
+    def __init__(self):
+        self.coins = {}
+        self.ts = {}
+        self.version = {}
+        self.listeners = []  # fn(거래소, 추가된 코인, 빠진 코인)
+        self._locks = {}
+
+    def listed(self, exchange, coin):
+        # 목록을 아직 모르면 None
+        coins = self.coins.get(exchange)
+        return None if coins is None else coin in coins
+
+    async def get(self, exchange, max_age=MARKET_TTL):
+        if _time.time() - self.ts.get(exchange, 0) > max_age:
+            lock = self._locks.get(exchange)
+            if lock is None:
+                lock = self._locks[exchange] = asyncio.Lock()
+            async with lock:
+                if _time.time() - self.ts.get(exchange, 0) > max_age:
+                    await self.refresh(exchange)
+        return self.coins.get(exchange, frozenset())
+
+    async def refresh(self, exchange):
+        adapter = EXCHANGES[exchange]
+        try:
+            coins = await asyncio.wait_for(adapter.listings(), adapter.timeout)
+        except Exception as e:
+            print(f"[{adapter.label} 상장 목록 갱신 실패] {e}")
+            return False
+        self.update(exchange, coins)
+        return True
+
+    def update(self, exchange, coins):
+        if not coins:
+            return
+        coins = frozenset(coins)
+        old = self.coins.get(exchange)
+        self.ts[exchange] = _time.time()
+        if old == coins:
+            return
+
+        self.coins[exchange] = coins
+        self.version[exchange] = self.version.get(exchange, 0) + 1
+        if old is None:
+            return
+
+        added, removed = coins - old, old - coins
+        print(f"[상장 변경] {EXCHANGE_NAME[exchange]} 추가 {sorted(added)} / 폐지 {sorted(removed)}")
+        METRICS.inc("market_listing_changes_total", [("exchange", exchange)])
+        for fn in self.listeners:
+            try:
+                fn(exchange, added, removed)
+            except Exception as e:
+                print(f"[상장 변경 처리 오류] {e}")
+
+MARKETS = MarketCache()
+
+def _notify_both_listed(exchange, added, removed):
+    # 다른 거래소에 이미 있던 코인이 새로 상장 → 거래소간 괴리 비교 가능해짐 → 자동 gap 구독자에게 알림
+    if not LISTING_NOTIFY or ROLE not in ("all", "sender"):
+        return
+    for coin in sorted(added):
+        others = [EXCHANGE_NAME[ex] for ex in EXCHANGES if ex != exchange and MARKETS.listed(ex, coin)]
+        if not others:
+            continue
+        text = f"🆕 {coin} {EXCHANGE_NAME[exchange]} 상장 → {'·'.join(others)}와 비교 가능\n/status {coin}"
+        for cid, cfg in load_gap_auto().items():
+            if cfg.get("enabled", False):
+                DISPATCHER.enqueue(int(cid), text)
+
+MARKETS.listeners.append(_notify_both_listed)
+
+async def market_refresh_loop():
+    while True:
+        await asyncio.gather(*(MARKETS.refresh(ex) for ex in EXCHANGES))
+        await asyncio.sleep(MARKET_REFRESH_SEC)
+
+#################################
+# 🛫 동시 요청 합치기 (single-flight)
+#################################
+
+class SingleFlight:
+    # (거래소, 엔드포인트, 심볼)이 같은 요청이 진행 중이면 새로 보내지 않고 그 결과를 같이 기다림
+    def __init__(self):
+        self.calls = {}  # 키 → Task
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            METRICS.inc("singleflight_shared_total", [("exchange", key[0]), ("endpoint", key[1])])
+        # 기다리던 쪽 하나가 취소돼도 나머지는 그대로 결과를 받음
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # 기다리던 쪽이 다 취소된 경우 "never retrieved" 경고 방지
+
+FLIGHTS = SingleFlight()
+
+#################################
+# 안전한 가격 조회 (0원 차단 + status 체크)
+#################################
+
+async def get_price(exchange, coin, max_age=None, stale_ok=False):
+    # stale_ok: 조회 실패/차단 중이면 STALE_MAX_SEC 이내 마지막 가격으로 대신함
+    # (호출부에서 PRICE_CACHE.age로 지연 여부 표시, 알람 판정에는 쓰지 않음)
+    cached = PRICE_CACHE.get(exchange, coin, max_age)
+    if cached:
+        return cached[0]
+
+    price = await _fetch_price(exchange, coin)
+    if price is None and stale_ok:
+        cached = PRICE_CACHE.get(exchange, coin, STALE_MAX_SEC)
+        if cached:
+            return cached[0]
+    return price
+
+async def _fetch_price(exchange, coin):
+    adapter = EXCHANGES.get(exchange)
+    if adapter is None:
+        return None
+
+    # 같은 코인 조회가 몰리면 요청 한 번을 같이 기다림
     try:
-        r = requests.get(
-            "https://api.bithumb.com/public/ticker/ALL_KRW",
-            timeout=5
-        )
-        data = r.json()
+        return await FLIGHTS.do((exchange, "ticker", coin), lambda: _fetch_price_once(adapter, coin))
+    except Exception:
+        return None
 
-        if data.get("status") != "0000":
-            return {}
+async def _fetch_price_once(adapter, coin):
+    price = await asyncio.wait_for(adapter.ticker(coin), adapter.timeout)
+    if not price or price <= 0:
+        return None
+
+    PRICE_CACHE.put(adapter.name, coin, price)
+    return price
+
+#################################
+# 📊 전체 코인 조회 (gap용)
+#################################
+
+async def get_all_prices(exchange, max_age=None, stale_ok=False):
+    cached = PRICE_CACHE.get_all(exchange, max_age)
+    if cached is not None:
+        return cached
 
-        raw = data['data']
+    try:
+        prices = await FLIGHTS.do((exchange, "tickers", "ALL"), lambda: _fetch_all_once(EXCHANGES[exchange]))
+    except Exception:
         prices = {}
 
-        for coin in raw:
-            if coin == "date":
-                continue
+    if not prices and stale_ok:
+        return PRICE_CACHE.get_all(exchange, STALE_MAX_SEC) or {}
+    return prices
 
-            price = float(raw[coin]['closing_price'])
+async def _fetch_all_once(adapter):
+    prices = await asyncio.wait_for(adapter.tickers(), adapter.timeout)
+    PRICE_CACHE.put_many(adapter.name, prices, full=True)
+    if adapter.bulk_only:
+        # 전체 시세 응답이 곧 상장 목록 → 추가 요청 없이 갱신
+        MARKETS.update(adapter.name, adapter.markets if adapter.markets is not None else prices)
+    return prices
 
-            if price > 0:
-                prices[coin] = price
+#################################
+# 📦 틱 단위 가격 스냅샷 (알람용)
+#################################
 
+async def get_prices(exchange, coins, max_age=None):
+    # 여러 마켓을 한 번의 요청으로 조회 (캐시에 신선한 코인은 제외)
+    adapter = EXCHANGES[exchange]
+    if adapter.bulk_only:
+        prices = await get_all_prices(exchange, max_age)
+        return {c: prices[c] for c in coins if c in prices}
+
+    prices = {}
+    missing = []
+    for c in coins:
+        cached = PRICE_CACHE.get(exchange, c, max_age)
+        if cached:
+            prices[c] = cached[0]
+        else:
+            missing.append(c)
+
+    if not missing:
         return prices
 
-    except:
-        return {}
+    try:
+        fetched = await FLIGHTS.do((exchange, "tickers", tuple(missing)), lambda: _fetch_many_once(adapter, missing))
+    except Exception:
+        return prices
+
+    prices.update(fetched)
+    return prices
+
+async def _fetch_many_once(adapter, coins):
+    fetched = await asyncio.wait_for(adapter.tickers(coins), adapter.timeout)
+    PRICE_CACHE.put_many(adapter.name, fetched)
+    return fetched
+
+async def build_price_snapshot(pairs, max_age=ALARM_MAX_AGE):
+    # pairs: (코인, 고가거래소, 저가거래소) 목록
+    # 틱마다 거래소별 1회 요청을 동시에 → 거래소 N개여도 가장 느린 곳만큼만 걸림
+    coins = {}
+    for coin, ex_high, ex_low in pairs:
+        for ex in (ex_high, ex_low):
+            if ex in EXCHANGES:
+                coins.setdefault(ex, set()).add(coin)
+
+    names = list(coins)
+    results = await asyncio.gather(*(get_prices(ex, sorted(coins[ex]), max_age) for ex in names))
+    return dict(zip(names, results))
 
 #################################
 # 🔒 입출금 상태 조회
 #################################
 
-def get_upbit_wallet_status(coin):
-    try:
-        payload = {
-            "access_key": UPBIT_ACCESS,
-            "nonce": str(uuid.uuid4())
-        }
-        token = jwt.encode(payload, UPBIT_SECRET, algorithm="HS256")
-        headers = {"Authorization": f"Bearer {token}"}
+# 거래소 → {"ts": 갱신시각, "data": {코인: (입금, 출금)}} (전체 자산 한 번에 조회)
+WALLET_CACHE = {name: {"ts": 0, "data": {}} for name in EXCHANGES}
 
-        r = requests.get(
-            "https://api.upbit.com/v1/status/wallet",
-            headers=headers,
-            proxies=PROXIES,
-            timeout=3
-        )
-        for item in r.json():
-            if item["currency"] == coin:
-                return item["wallet_state"]
-        return "unknown"
-    except:
-        return "unknown"
+async def refresh_wallets(exchange):
+    adapter = EXCHANGES[exchange]
+    if not adapter.has_wallets():
+        return False
 
-def get_bithumb_wallet_status(coin):
     try:
-        r = requests.get(
-            f"https://api.bithumb.com/public/assetsstatus/{coin}",
-            timeout=3
-        )
-        data = r.json()
-        if data["status"] == "0000":
-            d = data["data"]
-            return int(d["deposit_status"]), int(d["withdrawal_status"])
-        return None, None
-    except:
-        return None, None
-
-def build_status_msg(upbit_state, b_dep, b_wd):
+        table = await asyncio.wait_for(adapter.wallets(), adapter.timeout)
+    except Exception as e:
+        print(f"[{adapter.label} 입출금 상태 갱신 실패] {e}")
+        return False
+
+    WALLET_CACHE[exchange] = {"ts": _time.time(), "data": table}
+    return True
+
+async def get_wallet_table(exchange, max_age=WALLET_TTL):
+    # TTL 지나면 갱신 (동시 호출은 한 번만 갱신), 실패 시 이전 값 유지
+    if _time.time() - WALLET_CACHE[exchange]["ts"] > max_age:
+        await FLIGHTS.do((exchange, "wallets", "ALL"), lambda: refresh_wallets(exchange))
+    return WALLET_CACHE[exchange]["data"]
+
+async def get_wallet_status(exchange, coin):
+    table = await get_wallet_table(exchange)
+    return table.get(coin, (None, None))
+
+async def wallet_refresh_loop():
+    # 백그라운드 갱신 → 명령어 처리 중엔 캐시만 읽음
+    while True:
+        try:
+            await asyncio.gather(*(refresh_wallets(ex) for ex in EXCHANGES))
+        except Exception as e:
+            print(f"[입출금 상태 갱신 루프 오류] {e}")
+        await asyncio.sleep(WALLET_REFRESH_SEC)
+
+def wallet_label(dep, wd):
+    # → (아이콘, 설명)
+    if dep is None or wd is None:
+        return "❓", "❓ 알 수 없음"
+    if dep == 1 and wd == 1:
+        return "✅", "✅ 정상"
+    if dep == 0 and wd == 0:
+        return "⛔️", "⛔️ 입출금 중단"
+    if dep == 0:
+        return "⚠️", "⚠️ 입금불가"
+    return "⚠️", "⚠️ 출금불가"
+
+def build_status_msg(states):
+    # states: [(거래소 이름, 입금, 출금)]
     msgs = []
 
-    if upbit_state == "paused":
-        msgs.append("⛔️ 업비트 입출금 중단")
-    elif upbit_state == "withdraw_only":
-        msgs.append("⚠️ 업비트 입금불가")
-    elif upbit_state == "deposit_only":
-        msgs.append("⚠️ 업비트 출금불가")
-
-    if b_dep is not None and b_wd is not None:
-        if b_dep == 0 and b_wd == 0:
-            msgs.append("⛔️ 빗썸 입출금 중단")
-        elif b_dep == 0:
-            msgs.append("⚠️ 빗썸 입금불가")
-        elif b_wd == 0:
-            msgs.append("⚠️ 빗썸 출금불가")
+    for label, dep, wd in states:
+        if dep is None or wd is None:
+            continue
+        if dep == 0 and wd == 0:
+            msgs.append(f"⛔️ {label} 입출금 중단")
+        elif dep == 0:
+            msgs.append(f"⚠️ {label} 입금불가")
+        elif wd == 0:
+            msgs.append(f"⚠️ {label} 출금불가")
 
     return "\n".join(msgs) if msgs else "✅ 입출금 정상"
 
+#################################
+# 📮 발송 큐 (텔레그램 속도 제한 + 채팅별 묶음)
+#################################
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = _time.monotonic()
+        self.blocked_until = 0
+
+    def wait_time(self):
+        now = _time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, sec):
+        # 429 retry_after 동안 막기
+        self.blocked_until = max(self.blocked_until, _time.monotonic() + sec)
+
+    def idle(self):
+        # 가득 찼고 막혀있지도 않음 → 버려도 새로 만든 것과 같음
+        return self.wait_time() <= 0 and self.tokens >= self.burst
+
+class Dispatcher:
+    # 평가 루프는 enqueue만 하고 바로 리턴 → 실제 전송은 run()이 한도 안에서 처리
+    def __init__(self, global_rate, chat_rate, workers):
+        self.pending = {}    # chat_id → deque[(text, 넣은시각, 시도횟수, 묶기허용)]
+        self.ready = deque()  # 대기 메시지가 있는 chat_id (FIFO)
+        self.inflight = set()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.pruned_at = _time.monotonic()
+        self.workers = asyncio.Semaphore(workers)
+        self.wake = asyncio.Event()
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=1000)
+
+    def enqueue(self, chat_id, text, coalesce=True):
+        q = self.pending.get(chat_id)
+        if q is None:
+            q = self.pending[chat_id] = deque()
+            self.ready.append(chat_id)
+        q.append((text, _time.monotonic(), 0, coalesce))
+        self.wake.set()
+
+    def depth(self):
+        return sum(len(q) for q in self.pending.values())
+
+    def stats(self):
+        lat = sorted(self.latencies)
+        pct = lambda p: lat[min(len(lat) - 1, int(len(lat) * p))] if lat else 0
+        return {
+            "depth": self.depth(),
+            "chats": len(self.pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "latency_max": lat[-1] if lat else 0,
+        }
+
+    def _bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            b = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return b
+
+    def _prune(self):
+        # 대기/발송 중 메시지가 없고 다 찬 버킷은 지움 → 채팅 수만큼 계속 쌓이지 않게
+        self.pruned_at = _time.monotonic()
+        for cid in [cid for cid, b in self.chat_buckets.items() if b.idle()]:
+            if cid not in self.pending and cid not in self.inflight:
+                del self.chat_buckets[cid]
+
+    def _pick(self):
+        # 보낼 수 있는 채팅 하나 고르기 → (chat_id, None) 또는 (None, 최소 대기시간)
+        min_wait = None
+        for _ in range(len(self.ready)):
+            cid = self.ready.popleft()
+            if cid in self.inflight:
+                self.ready.append(cid)
+                continue
+            wait = self._bucket(cid).wait_time()
+            if wait <= 0:
+                return cid, None
+            self.ready.append(cid)
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    def _drain(self, chat_id):
+        # 같은 채팅에 쌓인 메시지를 한도(4096자) 안에서 하나로 합침
+        q = self.pending[chat_id]
+        items = [q.popleft()]
+        if items[0][3]:
+            size = len(items[0][0])
+            while q and q[0][3] and size + 2 + len(q[0][0]) <= MAX_MESSAGE_LEN:
+                size += 2 + len(q[0][0])
+                items.append(q.popleft())
+        if not q:
+            del self.pending[chat_id]
+        return items
+
+    def _requeue(self, chat_id, items):
+        q = self.pending.get(chat_id)
+        if q is None:
+            q = self.pending[chat_id] = deque()
+            self.ready.appendleft(chat_id)
+        for text, ts, tries, coalesce in reversed(items):
+            q.appendleft((text, ts, tries + 1, coalesce))
+
+    async def run(self, bot):
+        while True:
+            try:
+                if _time.monotonic() - self.pruned_at > SEND_BUCKET_PRUNE_SEC:
+                    self._prune()
+                cid, wait = self._pick()
+                if cid is None:
+                    self.wake.clear()
+                    try:
+                        await asyncio.wait_for(self.wake.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                gwait = self.global_bucket.wait_time()
+                if gwait > 0:
+                    self.ready.appendleft(cid)
+                    await asyncio.sleep(gwait)
+                    continue
+
+                self.global_bucket.take()
+                self._bucket(cid).take()
+                items = self._drain(cid)
+                if cid in self.pending:
+                    self.ready.append(cid)
+
+                await self.workers.acquire()
+                self.inflight.add(cid)
+                asyncio.create_task(self._send(bot, cid, items))
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[발송 큐 오류] {e}")
+                await asyncio.sleep(1)
+
+    async def _send(self, bot, chat_id, items):
+        text = "\n\n".join(t for t, _, _, _ in items)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            now = _time.monotonic()
+            self.sent += 1
+            self.coalesced += len(items) - 1
+            for _, ts, _, _ in items:
+                self.latencies.append(now - ts)
+
+        except RetryAfter as e:
+            wait = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            print(f"[발송 제한] chat_id={chat_id} {wait}초 대기")
+            # 429 는 봇 전체 한도 초과일 수 있음 → 다른 채팅 발송도 같이 멈춤
+            self._bucket(chat_id).block(wait)
+            self.global_bucket.block(wait)
+            self.retried += 1
+            self._requeue(chat_id, items)
+
+        except TimedOut as e:
+            # 요청은 갔는데 응답만 늦었을 수 있음 → 다시 보내면 중복 발송이라 버림 (최대 한 번 전달)
+            self.failed += 1
+            print(f"[알람 전송 시간 초과] chat_id={chat_id} → {e} (중복 방지로 재시도 안 함)")
+
+        except NetworkError as e:
+            if items[0][2] + 1 < SEND_MAX_RETRY:
+                self.retried += 1
+                self._bucket(chat_id).block(1)
+                self._requeue(chat_id, items)
+            else:
+                self.failed += 1
+                print(f"[알람 전송 실패] chat_id={chat_id} → {e}")
+
+        except Exception as e:
+            self.failed += 1
+            print(f"[알람 전송 실패] chat_id={chat_id} → {e}")
+
+        finally:
+            self.inflight.discard(chat_id)
+            self.workers.release()
+            self.wake.set()
+
+DISPATCHER = Dispatcher(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_WORKERS)
+
+async def dispatcher_report_loop():
+    # 1분마다 대기열/지연 로그 (활동 있을 때만)
+    last_sent = 0
+    while True:
+        await asyncio.sleep(60)
+        st = DISPATCHER.stats()
+        if st["depth"] or st["sent"] != last_sent:
+            print(
+                f"[발송 큐] 대기 {st['depth']}건/{st['chats']}채팅, 전송 {st['sent']}, "
+                f"실패 {st['failed']}, 재시도 {st['retried']}, 묶음 {st['coalesced']}, "
+                f"지연 p50 {st['latency_p50']:.2f}s p95 {st['latency_p95']:.2f}s"
+            )
+        last_sent = st["sent"]
+
 #################################
 # 명령어
 #################################
@@ -274,11 +1476,14 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/delete 번호\n"
         "/night\n"
         "/gap 0.5\n"
+        "/gap 0.5 업비트 빗썸 ← 거래소 지정 (기본 업비트↔빗썸)\n"
+        "/gap 1 size=500만 ← 500만원 호가 체결 기준 괴리\n"
         "/gap on 1 10  ← 1% 이상, 10분마다 자동 알람\n"
         "/gap on 1 30  ← 1% 이상, 30분마다 자동 알람\n"
         "/gap on 1     ← 분 생략시 기본 30분\n"
         "/gap off      ← 자동 알람 중단\n"
-        "/status ETH   ← 현재가 및 괴리율 조회"
+        "/status ETH   ← 현재가 및 괴리율 조회\n"
+        "/history ETH 24h ← 괴리율 기록 (30m / 6h / 7d)"
     )
 
 async def set_alarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -298,21 +1503,43 @@ async def set_alarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if ex_high_kr not in EXCHANGE_MAP or ex_low_kr not in EXCHANGE_MAP:
-        await update.message.reply_text("거래소 이름 오류\n예) 업비트, 빗썸")
+    ex_high, ex_low = resolve_exchange(ex_high_kr), resolve_exchange(ex_low_kr)
+    if ex_high is None or ex_low is None or ex_high == ex_low:
+        await update.message.reply_text(f"거래소 이름 오류\n예) {', '.join(EXCHANGE_MAP)}")
         return
+    ex_high_kr, ex_low_kr = EXCHANGE_NAME[ex_high], EXCHANGE_NAME[ex_low]
 
     try:
         diff = float(diff)
     except:
         await update.message.reply_text("차익은 숫자로 입력")
         return
+    if not math.isfinite(diff):
+        await update.message.reply_text("차익은 숫자로 입력")
+        return
+
+    # 캐시된 상장 목록으로 먼저 거름 → 없는 코인은 시세 요청 없이 바로 안내
+    for ex in (ex_high, ex_low):
+        if MARKETS.listed(ex, coin) is False:
+            await update.message.reply_text(
+                f"❌ {EXCHANGE_NAME[ex]}에 상장되지 않은 코인: {coin}\n"
+                f"심볼을 영문으로 다시 확인해주세요\n"
+                f"예) ETH, BTC, XRP"
+            )
+            return
 
     # 저장 전 가격 조회 검증
     await update.message.reply_text(f"🔍 {coin} 조회 확인중...")
 
-    high = get_price(EXCHANGE_MAP[ex_high_kr], coin)
-    low = get_price(EXCHANGE_MAP[ex_low_kr], coin)
+    high, low = await asyncio.gather(
+        get_price(ex_high, coin, SET_MAX_AGE),
+        get_price(ex_low, coin, SET_MAX_AGE)
+    )
+
+    for ex, price in ((ex_high, high), (ex_low, low)):
+        if price is None and circuit_open(ex):
+            await update.message.reply_text(f"⚠️ {EXCHANGE_NAME[ex]} 응답 지연/장애로 확인 불가\n잠시 후 다시 시도해주세요")
+            return
 
     if high is None:
         await update.message.reply_text(
@@ -333,21 +1560,23 @@ async def set_alarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     username = f"@{user.username}" if user.username else user.full_name
 
-    alarms = load_alarms()
     cid = update.effective_chat.id
 
-    alarms.append({
+    alarm = {
+        "id": new_alarm_id(),
         "chat_id": cid,
         "username": username,
-        "ex_high": EXCHANGE_MAP[ex_high_kr],
-        "ex_low": EXCHANGE_MAP[ex_low_kr],
+        "ex_high": ex_high,
+        "ex_low": ex_low,
         "kr_high": ex_high_kr,
         "kr_low": ex_low_kr,
         "coin": coin,
         "diff": diff
-    })
+    }
 
-    save_alarms(alarms)
+    add_alarm(alarm)
+    ALARM_INDEX.add(alarm)
+    notify_alarms_changed()
     await update.message.reply_text(
         f"✅ 알람 저장 완료\n"
         f"{ex_high_kr} : {fmt(high)}원\n"
@@ -383,19 +1612,31 @@ async def delete_alarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if idx < 0 or idx >= len(my):
         return
 
-    alarms.remove(my[idx])
-    save_alarms(alarms)
+    remove_alarm(my[idx]["id"])
+    ALARM_INDEX.remove(my[idx]["id"])
+    ALERT_STATE.remove(my[idx]["id"])
+    notify_alarms_changed()
 
     await update.message.reply_text("🗑 삭제 완료")
 
 async def night_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = load_night()
     cid = str(update.effective_chat.id)
+    on = not load_night().get(cid, False)
 
-    data[cid] = not data.get(cid, False)
-    save_night(data)
+    set_night(cid, on)
+    ALARM_INDEX.set_night(cid, on)
+    notify_alarms_changed()
 
-    await update.message.reply_text(f"밤모드 {'ON' if data[cid] else 'OFF'}")
+    await update.message.reply_text(f"밤모드 {'ON' if on else 'OFF'}")
+
+def _stale_mark(exchange, coin, price, max_age):
+    # 장애로 예전 가격을 보여줄 때 붙이는 표시
+    if not price:
+        return ""
+    age = PRICE_CACHE.age(exchange, coin)
+    if age is None or age <= max_age + 1:
+        return ""
+    return f" ⚠️ {int(age)}초 전 가격"
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -406,49 +1647,72 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(f"🔍 {coin} 조회중...")
 
-    upbit_price = get_price("upbit", coin)
-    bithumb_price = get_price("bithumb", coin)
-    b_dep, b_wd = get_bithumb_wallet_status(coin)
-
-    if b_dep is None:
-        bithumb_wallet = "❓ 알 수 없음"
-    elif b_dep == 1 and b_wd == 1:
-        bithumb_wallet = "✅ 정상"
-    elif b_dep == 0 and b_wd == 0:
-        bithumb_wallet = "⛔️ 입출금 중단"
-    elif b_dep == 0:
-        bithumb_wallet = "⚠️ 입금불가"
-    elif b_wd == 0:
-        bithumb_wallet = "⚠️ 출금불가"
-    else:
-        bithumb_wallet = "❓ 알 수 없음"
+    # 등록된 거래소 시세 + 입출금 상태를 한 번에 동시 조회
+    names = list(EXCHANGES)
+    wallet_ex = [ex for ex in names if EXCHANGES[ex].has_wallets()]
+    results = await asyncio.gather(
+        *(get_price(ex, coin, STATUS_MAX_AGE, stale_ok=True) for ex in names),
+        *(get_wallet_status(ex, coin) for ex in wallet_ex)
+    )
+    prices, wallets = results[:len(names)], results[len(names):]
+
+    msg = f"📊 {coin} 현황\n"
+    for ex, price in zip(names, prices):
+        msg += f"{EXCHANGE_NAME[ex]} : {fmt(price) if price else '조회 실패'}원{_stale_mark(ex, coin, price, STATUS_MAX_AGE)}\n"
+
+    # 괴리율은 첫 번째 거래소 기준 (거래소가 둘이면 한 줄)
+    base, base_price = names[0], prices[0]
+    for ex, price in zip(names[1:], prices[1:]):
+        title = "📊 괴리율" if len(names) == 2 else f"📊 {EXCHANGE_NAME[base]}↔{EXCHANGE_NAME[ex]}"
+        if base_price and price:
+            msg += f"{title} : {(base_price - price) / price * 100:+.3f}%\n"
+        else:
+            msg += f"{title} : 조회 실패\n"
 
-    if upbit_price and bithumb_price:
-        gap_pct = (upbit_price - bithumb_price) / bithumb_price * 100
-        gap_line = f"📊 괴리율 : {gap_pct:+.3f}%"
-    else:
-        gap_line = "📊 괴리율 : 조회 실패"
+    states = []
+    for ex, (dep, wd) in zip(wallet_ex, wallets):
+        msg += f"{EXCHANGE_NAME[ex]} 입출금 : {wallet_label(dep, wd)[1]}\n"
+        states.append((EXCHANGE_NAME[ex], dep, wd))
 
-    msg = (
-        f"📊 {coin} 현황\n"
-        f"업비트 : {fmt(upbit_price) if upbit_price else '조회 실패'}원\n"
-        f"빗썸 : {fmt(bithumb_price) if bithumb_price else '조회 실패'}원\n"
-        f"{gap_line}\n"
-        f"빗썸 입출금 : {bithumb_wallet}"
-    )
+    # 입출금 상태를 아는 거래소가 둘 이상일 때만 요약
+    if len(states) >= 2:
+        msg += f"\n{build_status_msg(states)}"
 
-    await update.message.reply_text(msg)
+    await update.message.reply_text(msg.rstrip("\n"))
 
 
+def _split_pair(args):
+    # 인자 중 거래소 이름 두 개를 골라냄 → (거래소쌍 또는 None, 나머지 인자)
+    pair, rest = [], []
+    for arg in args:
+        ex = resolve_exchange(arg)
+        if ex:
+            pair.append(ex)
+        else:
+            rest.append(arg)
+    if not pair:
+        return DEFAULT_GAP_PAIR, rest
+    if len(pair) != 2 or pair[0] == pair[1]:
+        return None, rest
+    return tuple(pair), rest
+
 async def gap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pair, args = _split_pair(context.args or [])
+    if pair is None:
+        await update.message.reply_text(f"거래소는 두 곳을 적어줘.\n예) /gap 0.5 {' '.join(list(EXCHANGE_MAP)[:2])}")
+        return
+    context.args = args
+
     if context.args and context.args[0].lower() == "on":
         if len(context.args) < 2:
             await update.message.reply_text("사용법: /gap on [퍼센트] [분]\n예) /gap on 1 10  (1% 이상, 10분마다)")
             return
         try:
             threshold = float(context.args[1])
+            if not math.isfinite(threshold):
+                raise ValueError
         except:
-            await update.message.reply_text("퍼센트는 숫자로 입력해줘.\n예) /gap on 1 10")
+            await update.message.reply_text("사용법: /gap on [퍼센트] [분]\n예) /gap on 1 10  (1% 이상, 10분마다)")
             return
 
         interval_min = 30
@@ -462,110 +1726,390 @@ async def gap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("분은 1 이상 정수로 입력해줘.\n예) /gap on 1 10")
                 return
 
-        data = load_gap_auto()
         cid = str(update.effective_chat.id)
-        data[cid] = {
+        save_gap_auto({cid: {
             "threshold": threshold,
             "interval_min": interval_min,
+            "pair": list(pair),
             "enabled": True,
             "next_run": 0
-        }
-        save_gap_auto(data)
+        }})
+        schedule_gap_auto(cid, 0)
 
+        names = "·".join(EXCHANGE_NAME[ex] for ex in pair if EXCHANGES[ex].has_wallets())
         await update.message.reply_text(
-            f"✅ 자동 gap 알람 ON\n"
-            f"조건 : {threshold}% 이상 & 빗썸 입출금 정상\n"
+            f"✅ 자동 gap 알람 ON ({EXCHANGE_NAME[pair[0]]}↔{EXCHANGE_NAME[pair[1]]})\n"
+            f"조건 : {threshold}% 이상 & {names} 입출금 정상\n"
             f"주기 : {interval_min}분마다"
         )
         return
 
     if context.args and context.args[0].lower() == "off":
-        data = load_gap_auto()
-        cid = str(update.effective_chat.id)
-        if cid in data:
-            data[cid]["enabled"] = False
-            save_gap_auto(data)
+        cfg = load_gap_auto().get(str(update.effective_chat.id))
+        if cfg:
+            cfg["enabled"] = False
+            save_gap_auto({str(update.effective_chat.id): cfg})
         await update.message.reply_text("🔕 자동 gap 알람 OFF")
         return
 
+    # size=500만 → 호가 체결 기준 괴리도 같이
+    size = None
+    for arg in list(context.args):
+        if arg.lower().startswith("size="):
+            context.args.remove(arg)
+            try:
+                size = _parse_krw(arg[5:])
+            except ValueError:
+                await update.message.reply_text("금액은 원 단위 숫자로 입력해줘.\n예) /gap 1 size=5000000")
+                return
+
     if not context.args:
-        await update.message.reply_text("사용법: /gap 0.5")
+        await update.message.reply_text("사용법: /gap 0.5 [size=5000000]")
         return
 
     try:
         threshold = float(context.args[0])
+        if not math.isfinite(threshold):
+            raise ValueError
     except:
-        await update.message.reply_text("숫자만 입력해줘.")
+        await update.message.reply_text("사용법: /gap 0.5 [size=5000000]")
         return
 
-    await _send_gap_result(update.effective_chat.id, threshold, update.message)
+    await _send_gap_result(update.effective_chat.id, threshold, update.message, pair=pair, size=size)
+
 
+#################################
+# 🧮 괴리율 엔진 (numpy 일괄 계산)
+#################################
+
+class GapSnapshot:
+    # 한 시점의 두 거래소(a, b) 공통 코인 배열 + |괴리율| 내림차순 정렬. 괴리율 = (a - b) / b
+    def __init__(self, symbols, a, b, fee_a, fee_b):
+        self.symbols = symbols
+        self.a = a
+        self.b = b
+        self.gap_pct = (a - b) / b * 100
+        self.spread = a - b
+
+        # 싼 곳에서 사서 비싼 곳에 팔 때 양쪽 수수료 차감
+        fees = a * fee_a + b * fee_b
+        self.net = np.abs(self.spread) - fees
+        self.net_pct = self.net / np.minimum(a, b) * 100
+
+        self.order = np.argsort(-np.abs(self.gap_pct), kind="stable")
+        self.sorted_abs = np.abs(self.gap_pct)[self.order]
+
+    def count(self, threshold):
+        # |괴리율| >= threshold 인 코인 수 (정렬 배열에서 이진탐색)
+        return int(np.searchsorted(-self.sorted_abs, -threshold, side="right"))
+
+    def top(self, threshold, k=20):
+        # → [(코인, 괴리율%, 가격차, 순차익%)] |괴리율| 큰 순
+        idx = self.order[:min(self.count(threshold), k)]
+        return [
+            (self.symbols[i], float(self.gap_pct[i]), float(self.spread[i]), float(self.net_pct[i]))
+            for i in idx
+        ]
+
+class GapEngine:
+    # 거래소 쌍별 공통 코인 정렬 인덱스는 상장 목록이 바뀔 때만 다시 만듦
+    def __init__(self):
+        self.listings = {}  # (거래소a, 거래소b) → (상장 목록 버전, 공통 코인 목록)
+
+    def _symbols(self, pair, a, b):
+        version = tuple(MARKETS.version.get(ex) for ex in pair)
+        if None in version:
+            # 상장 목록을 아직 못 받음 → 이번 시세에서 바로 계산
+            return sorted(c for c in a if c in b)
+        cached = self.listings.get(pair)
+        if cached is None or cached[0] != version:
+            common = MARKETS.coins[pair[0]] & MARKETS.coins[pair[1]]
+            cached = self.listings[pair] = (version, sorted(common))
+        return cached[1]
+
+    def compute(self, pair, a, b):
+        symbols = self._symbols(pair, a, b)
+
+        n = len(symbols)
+        va = np.fromiter((a.get(c, np.nan) for c in symbols), dtype=np.float64, count=n)
+        vb = np.fromiter((b.get(c, np.nan) for c in symbols), dtype=np.float64, count=n)
+
+        # 상장돼 있어도 이번 시세에 빠진 코인(0원 등)은 제외
+        ok = ~(np.isnan(va) | np.isnan(vb))
+        if not ok.all():
+            symbols = [c for c, k in zip(symbols, ok) if k]
+            va, vb = va[ok], vb[ok]
+        return GapSnapshot(symbols, va, vb, FEE_RATE[pair[0]], FEE_RATE[pair[1]])
+
+GAP_ENGINE = GapEngine()
+
+async def fetch_gap_market(pair=DEFAULT_GAP_PAIR):
+    # 전체 시세 비교 1회분 → 여러 구독자가 임계값만 달리해서 재사용
+    a, b = await asyncio.gather(*(get_all_prices(ex, GAP_MAX_AGE, stale_ok=True) for ex in pair))
+
+    if not a or not b:
+        return None
 
-async def _send_gap_result(chat_id, threshold, reply_to=None):
+    # 장애로 예전 시세를 쓴 거래소 → 안내 문구용
+    stale = {}
+    for ex in pair:
+        age = PRICE_CACHE.age(ex)
+        if age is not None and age > GAP_MAX_AGE + 1:
+            stale[ex] = age
+
+    wallet_ex = [ex for ex in pair if EXCHANGES[ex].has_wallets()]
+    tables = await asyncio.gather(*(get_wallet_table(ex) for ex in wallet_ex))
+
+    return {
+        "pair": tuple(pair),
+        "gaps": GAP_ENGINE.compute(tuple(pair), a, b),
+        "wallets": dict(zip(wallet_ex, tables)),
+        "stale": stale,
+    }
+
+def _gap_lines(market, threshold, only_open, depth=None, limit=20):
+    # → [(코인, 괴리율, 표시 줄)] |괴리율| 큰 순, only_open 이면 입출금 전부 정상인 코인만
+    # limit=None 이면 임계값 넘는 코인 전부 (자동 gap 변화 감지용)
+    wallet_ex = [ex for ex in market["pair"] if ex in market["wallets"]]
+    if limit is None:
+        limit = market["gaps"].count(threshold)
+    rows = []
+    for coin, g, _, net in market["gaps"].top(threshold, limit):
+        icons = ""
+        is_open = True
+        for ex in wallet_ex:
+            dep, wd = market["wallets"][ex].get(coin, (None, None))
+            icons += f" {EXCHANGE_NAME[ex][0]}{wallet_label(dep, wd)[0]}"
+            is_open = is_open and dep == 1 and wd == 1
+
+        if only_open and not is_open:
+            continue
+
+        line = f"{coin} : {g:+.3f}% (순 {net:+.3f}%) |{icons}"
+        if depth is not None and coin in depth:
+            side, spread, profit, net_pct, full = depth[coin]
+            line += (
+                f"\n   └ {EXCHANGE_NAME[market['pair'][side]]} 매수 체결 {spread:+.3f}% "
+                f"(순 {net_pct:+.3f}%, {profit:+,.0f}원)"
+            )
+            if not full:
+                line += " ⚠️호가 부족"
+        rows.append((coin, g, line))
+    return rows
+
+def _gap_header(market, threshold, title="괴리율"):
+    a, b = market["pair"]
+    names = "·".join(EXCHANGE_NAME[ex] for ex in market["pair"] if ex in market["wallets"])
+    header = f"📊 {EXCHANGE_NAME[a]}↔{EXCHANGE_NAME[b]} {title} ({threshold}%↑, {names}정상만)\n"
+    for ex, age in market.get("stale", {}).items():
+        header += f"⚠️ {EXCHANGE_NAME[ex]} 응답 지연 → {int(age)}초 전 시세\n"
+    return header
+
+def _chunks(header, lines, chunk_size=10):
+    # 메시지 하나에 10줄씩, 머리말은 첫 메시지에만
+    return [
+        (header if i == 0 else "") + "\n".join(lines[i:i + chunk_size])
+        for i in range(0, len(lines), chunk_size)
+    ]
+
+async def _send_gap_result(chat_id, threshold, reply_to=None, market=None, pair=DEFAULT_GAP_PAIR, size=None):
     async def send(text):
         if reply_to:
             await reply_to.reply_text(text)
         else:
-            await _APP.bot.send_message(chat_id=chat_id, text=text)
-
-    await send("📊 전체 코인 비교중...")
+            DISPATCHER.enqueue(chat_id, text)
 
-    upbit = get_upbit_all()
-    bithumb = get_bithumb_all()
+    if market is None:
+        await send("📊 전체 코인 비교중...")
+        market = await fetch_gap_market(pair)
 
-    if not upbit or not bithumb:
+    if market is None:
         await send("가격 조회 실패")
         return
 
-    results = []
-    for coin in upbit:
-        if coin in bithumb and bithumb[coin] > 0:
-            gap = (upbit[coin] - bithumb[coin]) / bithumb[coin] * 100
-            if abs(gap) >= threshold:
-                results.append((coin, round(gap, 3)))
-
-    if not results:
+    if not market["gaps"].count(threshold):
         await send(f"📊 {threshold}% 이상 괴리 코인 없음")
         return
 
-    results.sort(key=lambda x: abs(x[1]), reverse=True)
-    top = results[:20]
+    # 금액 지정 → 전체 |괴리율| 상위 N개 호가로 체결 기준 계산 (임계값과 무관하게 같은 목록 → 사용자끼리 공유)
+    depth = None
+    if size:
+        coins = [c for c, _, _, _ in market["gaps"].top(0, ORDERBOOK_TOP_N)]
+        depth = await DEPTH_ENGINE.executable(market["pair"], coins, size)
 
-    await send("🔒 빗썸 입출금 상태 조회중...")
+    # 입출금 상태를 아는 거래소만 아이콘 표시 + 자동 알람은 전부 정상인 코인만
+    rows = _gap_lines(market, threshold, reply_to is None, depth)
 
-    lines = []
-    for coin, g in top:
-        b_dep, b_wd = get_bithumb_wallet_status(coin)
+    if not rows:
+        if reply_to is None:
+            return
+        names = "·".join(EXCHANGE_NAME[ex] for ex in market["pair"] if ex in market["wallets"])
+        await send(f"조건 만족 코인 없음 ({names} 입출금 정상 기준)")
+        return
 
-        if b_dep is None:
-            b_icon = "❓"
-            is_open = False
-        elif b_dep == 1 and b_wd == 1:
-            b_icon = "✅"
-            is_open = True
-        elif b_dep == 0 and b_wd == 0:
-            b_icon = "⛔️"
-            is_open = False
-        else:
-            b_icon = "⚠️"
-            is_open = False
+    header = _gap_header(market, threshold)
+    if depth is not None:
+        header += f"💰 {fmt(size)}원 호가 체결 기준 (상위 {ORDERBOOK_TOP_N}개)\n"
+    for text in _chunks(header, [line for _, _, line in rows]):
+        await send(text)
+
+#################################
+# 🔁 자동 gap 변화 감지 (지난번과 달라진 것만 발송)
+#################################
 
-        if reply_to is None and not is_open:
+def gap_fingerprint(rows):
+    # 마지막으로 보낸 결과 요약 → {코인: 괴리율(소수 2자리)} (구독 설정에 같이 저장)
+    # 화면에 보이는 상위 20개가 아니라 임계값 넘는 코인 전부 → 순위만 바뀐 코인을 빠짐/새로 들어옴으로 보지 않음
+    return {coin: round(g, 2) for coin, g, _ in rows}
+
+def gap_changes(last, rows):
+    # → (새로 들어온 줄, 빠진 코인, [(코인, 기준 괴리율, 지금)] GAP_AUTO_MOVE 이상 움직인 것, 다음 기준)
+    added, moved = [], []
+    base = {}
+    for coin, g, line in rows:
+        prev = last.get(coin)
+        if prev is None:
+            added.append(line)
+        elif abs(g - prev) >= GAP_AUTO_MOVE:
+            moved.append((coin, prev, g))
+        else:
+            # 조금씩 움직이면 기준은 그대로 → 쌓여서 GAP_AUTO_MOVE 넘으면 알림
+            base[coin] = prev
             continue
+        base[coin] = round(g, 2)
+    dropped = [coin for coin in last if coin not in base]
+    return added, dropped, moved, base
 
-        lines.append(f"{coin} : {g:+.3f}% | 빗{b_icon}")
+def _send_gap_diff(chat_id, threshold, market, rows, last):
+    # 같은 (거래소쌍, 임계값) 구독자는 rows 를 공유 → 구독자마다는 최대 20개 dict 비교만
+    # → 다음 기준 지문
+    added, dropped, moved, base = gap_changes(last, rows)
+    if not (added or dropped or moved):
+        METRICS.inc("gap_auto_suppressed_total")
+        return last
 
-    if not lines:
-        if reply_to is None:
-            return
-        await send("조건 만족 코인 없음 (빗썸 입출금 정상 기준)")
-        return
+    lines = [f"🆕 {line}" for line in added]
+    for coin, prev, g in moved:
+        lines.append(f"{'📈' if abs(g) > abs(prev) else '📉'} {coin} : {prev:+.2f}% → {g:+.2f}%")
+    lines += [f"👋 {coin} 조건 벗어남" for coin in dropped]
 
-    chunk_size = 10
-    for i in range(0, len(lines), chunk_size):
-        chunk = lines[i:i + chunk_size]
-        header = f"📊 업비트↔빗썸 괴리율 ({threshold}%↑, 빗썸정상만)\n" if i == 0 else ""
-        await send(header + "\n".join(chunk))
+    METRICS.inc("gap_auto_diff_total")
+    for text in _chunks(_gap_header(market, threshold, "괴리 변화"), lines):
+        DISPATCHER.enqueue(chat_id, text)
+    return base
+
+
+#################################
+# 📚 호가 기반 체결 괴리 (상위 코인 호가 일괄 조회)
+#################################
+
+def _fill_buy(asks, krw):
+    # 매도호가를 싼 것부터 먹으며 krw 만큼 매수 → (수량, 쓴 금액). 호가가 모자라면 쓴 금액 < krw
+    if not len(asks):
+        return 0.0, 0.0
+    px, qty = asks[:, 0], asks[:, 1]
+    cost = np.cumsum(px * qty)
+    i = int(np.searchsorted(cost, krw))
+    if i >= len(px):
+        return float(qty.sum()), float(cost[-1])
+    done = cost[i - 1] if i else 0.0
+    return float(qty[:i].sum() + (krw - done) / px[i]), float(krw)
+
+def _fill_sell(bids, amount):
+    # 매수호가를 비싼 것부터 먹으며 amount 개 매도 → (판 수량, 받은 금액)
+    if not len(bids):
+        return 0.0, 0.0
+    px, qty = bids[:, 0], bids[:, 1]
+    filled = np.cumsum(qty)
+    i = int(np.searchsorted(filled, amount))
+    if i >= len(px):
+        return float(filled[-1]), float((px * qty).sum())
+    done = filled[i - 1] if i else 0.0
+    return float(amount), float((px[:i] * qty[:i]).sum() + (amount - done) * px[i])
+
+def executable_spread(book_a, book_b, krw, fee_a, fee_b):
+    # 중간가가 싼 쪽 매도호가로 krw 만큼 사서 비싼 쪽 매수호가에 전량 매도
+    # → (산 거래소 인덱스, 체결 괴리%, 수수료 뺀 순익원, 순익%, 다 체결됐는지)
+    mid_a = (book_a[0][0, 0] + book_a[1][0, 0]) / 2
+    mid_b = (book_b[0][0, 0] + book_b[1][0, 0]) / 2
+    if mid_a <= mid_b:
+        buy, sell, fee_buy, fee_sell, side = book_a, book_b, fee_a, fee_b, 0
+    else:
+        buy, sell, fee_buy, fee_sell, side = book_b, book_a, fee_b, fee_a, 1
+
+    amount, spent = _fill_buy(buy[0], krw)
+    sold, got = _fill_sell(sell[1], amount)
+    if not spent or not sold:
+        return side, 0.0, 0.0, 0.0, False
+
+    # 못 판 수량이 있으면 그만큼 산 금액도 비례로 줄여서 비교
+    spent_sold = spent * sold / amount
+    profit = got - spent_sold - spent_sold * fee_buy - got * fee_sell
+    return (
+        side,
+        (got / spent_sold - 1) * 100,
+        profit,
+        profit / spent_sold * 100,
+        spent >= krw and sold >= amount,
+    )
+
+class DepthEngine:
+    # 호가 조회 1회분(거래소쌍 + 코인 목록)을 ORDERBOOK_MAX_AGE 동안 공유
+    # 같은 금액 계산 결과도 그 호가 안에서 한 번만
+    def __init__(self):
+        self.snapshots = {}  # (거래소쌍, 코인 목록) → (시각, Task[{거래소: {코인: (매도호가, 매수호가)}}], {금액: 결과})
+
+    async def _fetch(self, pair, coins):
+        async def one(ex):
+            adapter = EXCHANGES[ex]
+            try:
+                return await asyncio.wait_for(adapter.orderbooks(list(coins)), adapter.timeout)
+            except Exception as e:
+                print(f"[{adapter.label} 호가 조회 실패] {e}")
+                return {}
+
+        books = await asyncio.gather(*(one(ex) for ex in pair))
+        return dict(zip(pair, books))
+
+    async def _snapshot(self, pair, coins):
+        now = _time.monotonic()
+        key = (pair, coins)
+        hit = self.snapshots.get(key)
+        if hit is None or now - hit[0] > ORDERBOOK_MAX_AGE:
+            for k in [k for k, v in self.snapshots.items() if now - v[0] > ORDERBOOK_MAX_AGE]:
+                del self.snapshots[k]
+            hit = self.snapshots[key] = (now, asyncio.ensure_future(self._fetch(pair, coins)), {})
+            METRICS.inc("orderbook_snapshots_total", [("pair", "_".join(pair))])
+        # 먼저 온 요청이 취소돼도 같이 기다리던 요청은 계속
+        return hit, await asyncio.shield(hit[1])
+
+    async def executable(self, pair, coins, krw):
+        # → {코인: executable_spread 결과}, 양쪽 호가가 다 있는 코인만
+        (_, _, results), books = await self._snapshot(tuple(pair), tuple(coins))
+        res = results.get(krw)
+        if res is None:
+            fee_a, fee_b = FEE_RATE[pair[0]], FEE_RATE[pair[1]]
+            a, b = books.get(pair[0], {}), books.get(pair[1], {})
+            res = results[krw] = {
+                c: executable_spread(a[c], b[c], krw, fee_a, fee_b)
+                for c in coins if c in a and c in b
+            }
+        return res
+
+DEPTH_ENGINE = DepthEngine()
+
+def _parse_krw(text):
+    # "5000000" / "5,000,000" / "500만" / "1억" → 원
+    text = text.replace(",", "").replace("원", "").strip()
+    unit = 1
+    for suffix, mul in (("억", 10 ** 8), ("만", 10 ** 4)):
+        if text.endswith(suffix):
+            text, unit = text[:-len(suffix)], mul
+            break
+    value = float(text) * unit
+    if not math.isfinite(value) or value <= 0:
+        raise ValueError(text)
+    return value
 
 
 #################################
@@ -596,138 +2140,1519 @@ async def users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 #################################
-# 🔔 알람 체크 루프 (2번 울리고 쿨다운)
+# 📈 지표 조회 (관리자용)
 #################################
 
-async def check_alarms(app):
-    alarms = load_alarms()
-    night_data = load_night()
-    now_night = is_night_time()
-    now = _time.time()
+def _collect_app_metrics():
+    METRICS.set("alarms", len(ALARM_INDEX.alarms))
+    METRICS.set("alarm_groups", len(ALARM_INDEX.groups))
+    METRICS.set("alert_state_entries", len(ALERT_STATE.states))
+    METRICS.set("gap_auto_subscribers", sum(
+        1 for cfg in load_gap_auto().values() if cfg.get("enabled", False)
+    ))
+    for tier, n in POLL_SCHED.tiers().items():
+        METRICS.set("alarm_poll_groups", n, [("tier", tier)])
+    for ex, on in STREAM_CONNECTED.items():
+        METRICS.set("stream_connected", 1 if on else 0, [("exchange", ex)])
+    for name, c in CIRCUITS.items():
+        METRICS.set("exchange_circuit_state", {"closed": 0, "half_open": 1, "open": 2}[c.state], [("exchange", name)])
+
+    st = DISPATCHER.stats()
+    METRICS.set("send_queue_depth", st["depth"])
+    METRICS.set("send_queue_chats", st["chats"])
+    METRICS.set_total("send_sent_total", st["sent"])
+    METRICS.set_total("send_failed_total", st["failed"])
+    METRICS.set_total("send_retried_total", st["retried"])
+    METRICS.set_total("send_coalesced_total", st["coalesced"])
+    METRICS.set("send_latency_seconds_p50", st["latency_p50"])
+    METRICS.set("send_latency_seconds_p95", st["latency_p95"])
+
+METRICS.collectors.append(_collect_app_metrics)
+
+def _ms(v):
+    return "-" if v is None else "∞" if v == float("inf") else f"{v * 1000:.0f}ms"
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
 
-    for a in alarms:
-        key = f"{a['chat_id']}_{a['coin']}_{a['ex_high']}_{a['ex_low']}"
-        state = ALERT_STATE.get(key, {"last_sent": 0, "active": False, "count": 0})
+    METRICS.render()  # 게이지 갱신
+    st = DISPATCHER.stats()
+    g = lambda name, labels=(): METRICS.gauges.get((name, tuple(labels)), 0)
+
+    msg = "📈 지표\n\n[거래소 응답]\n"
+    errors = {}
+    for (name, labels), v in METRICS.counters.items():
+        if name == "exchange_request_errors_total":
+            d = dict(labels)
+            key = (d["exchange"], d["endpoint"])
+            errors[key] = errors.get(key, 0) + v
+    for labels, n, total in sorted(METRICS.series("exchange_request_seconds")):
+        d = dict(labels)
+        p95 = METRICS.quantile("exchange_request_seconds", 0.95, labels)
+        err = errors.get((d["exchange"], d["endpoint"]), 0)
+        msg += (
+            f"{d['exchange']} {d['endpoint']} ({d['via']}) : {n}회 "
+            f"평균 {_ms(total / n)} p95≤{_ms(p95)} 오류 {err}\n"
+        )
+
+    for name, c in sorted(CIRCUITS.items()):
+        if c.state != "closed":
+            msg += f"🚧 {name} 차단기 {c.state} (연속 실패 {c.failures}, {c.retry_in():.0f}초 후 재시도)\n"
+
+    for labels, n, total in METRICS.series("alarm_tick_seconds"):
+        msg += (
+            f"\n[알람 루프] {n}틱 평균 {_ms(total / n)} "
+            f"p95≤{_ms(METRICS.quantile('alarm_tick_seconds', 0.95))} "
+            f"초과 {METRICS.counters.get(('alarm_tick_overruns_total', ()), 0)}\n"
+        )
+    for labels, n, total in METRICS.series("gap_auto_lag_seconds"):
+        msg += f"[자동 gap 지연] 평균 {_ms(total / n)} p95≤{_ms(METRICS.quantile('gap_auto_lag_seconds', 0.95))}\n"
+    msg += (
+        f"[이벤트 루프 지연] 최근 {_ms(g('event_loop_lag_seconds_last'))} "
+        f"p95≤{_ms(METRICS.quantile('event_loop_lag_seconds', 0.95))}\n"
+        f"\n[알람] {g('alarms')}개 / 그룹 {g('alarm_groups')} / 상태 {g('alert_state_entries')}\n"
+        f"[자동 gap 구독] {g('gap_auto_subscribers')}\n"
+        f"[발송 큐] 대기 {g('send_queue_depth')} / 전송 {st['sent']} / "
+        f"실패 {st['failed']} / 지연 p95 {_ms(g('send_latency_seconds_p95'))}"
+    )
 
-        high = get_price(a["ex_high"], a["coin"])
-        low = get_price(a["ex_low"], a["coin"])
+    await update.message.reply_text(msg)
+
+
+#################################
+# 🗂 알람 인덱스 (코인·거래소쌍별 임계값 정렬)
+#################################
+
+class AlarmIndex:
+    # (코인, 고가거래소, 저가거래소) 그룹마다 (임계값, 알람id) 정렬 목록을
+    # 낮/밤 두 벌로 유지 → 틱마다 그룹당 가격차 1번 계산 + bisect
+    def __init__(self):
+        self.alarms = {}      # 알람id → 알람
+        self.groups = {}      # 그룹키 → {"day": [...], "night": [...], "active": set()}
+        self.by_coin = {}     # 코인 → {그룹키}
+        self.thresholds = {}  # 알람id → (낮 임계값, 밤 임계값)
+        self.night = {}       # chat_id(str) → 밤모드 여부
+
+    @staticmethod
+    def key_of(a):
+        return (a["coin"], a["ex_high"], a["ex_low"])
+
+    def rebuild(self, alarms, night_data):
+        self.__init__()
+        self.night = {k: bool(v) for k, v in night_data.items()}
+        for a in alarms:
+            self.add(a)
+
+    def _thresholds(self, a):
+        diff = a["diff"]
+        return diff, diff * 2 if self.night.get(str(a["chat_id"]), False) else diff
+
+    def add(self, a):
+        if not math.isfinite(a["diff"]):
+            return
+        key = self.key_of(a)
+        g = self.groups.get(key)
+        if g is None:
+            g = self.groups[key] = {"day": [], "night": [], "active": set()}
+            self.by_coin.setdefault(a["coin"], set()).add(key)
+
+        day, night = self._thresholds(a)
+        self.alarms[a["id"]] = a
+        self.thresholds[a["id"]] = (day, night)
+        bisect.insort(g["day"], (day, a["id"]))
+        bisect.insort(g["night"], (night, a["id"]))
+
+    def remove(self, alarm_id):
+        a = self.alarms.pop(alarm_id, None)
+        if a is None:
+            return None
+
+        key = self.key_of(a)
+        g = self.groups[key]
+        day, night = self.thresholds.pop(alarm_id)
+        g["day"].remove((day, alarm_id))
+        g["night"].remove((night, alarm_id))
+        g["active"].discard(alarm_id)
+
+        if not g["day"]:
+            del self.groups[key]
+            keys = self.by_coin[a["coin"]]
+            keys.discard(key)
+            if not keys:
+                del self.by_coin[a["coin"]]
+        return a
+
+    def set_night(self, chat_id, on):
+        # 해당 채팅 알람만 밤 목록에서 다시 꽂기 (낮 목록·울림 상태는 그대로)
+        self.night[str(chat_id)] = on
+        for a in self.alarms.values():
+            if str(a["chat_id"]) != str(chat_id):
+                continue
+            g = self.groups[self.key_of(a)]
+            g["night"].remove((self.thresholds[a["id"]][1], a["id"]))
+            day, night = self.thresholds[a["id"]] = self._thresholds(a)
+            bisect.insort(g["night"], (night, a["id"]))
+
+    def crossed(self, key, gap, now_night):
+        # → (임계값 이하라 울려야 할 알람들, 임계값 위로 올라가 리셋할 알람id들)
+        g = self.groups.get(key)
+        if g is None:
+            return [], []
+
+        lst = g["night"] if now_night else g["day"]
+        i = bisect.bisect_right(lst, (gap, "\uffff"))
+        fired = [self.alarms[aid] for _, aid in lst[:i]]
+
+        col = 1 if now_night else 0
+        reset = [aid for aid in g["active"] if self.thresholds[aid][col] > gap]
+        return fired, reset
+
+    def distance(self, key, gap, now_night):
+        # 현재 가격차에서 가장 가까운 임계값까지 거리 (원)
+        g = self.groups.get(key)
+        if g is None:
+            return float("inf")
+        lst = g["night"] if now_night else g["day"]
+        i = bisect.bisect_right(lst, (gap, "\uffff"))
+        near = [lst[j][0] for j in (i - 1, i) if 0 <= j < len(lst)]
+        return min(abs(t - gap) for t in near) if near else float("inf")
+
+    def set_active(self, alarm_id, on):
+        a = self.alarms.get(alarm_id)
+        if a is None:
+            return
+        active = self.groups[self.key_of(a)]["active"]
+        if on:
+            active.add(alarm_id)
+        else:
+            active.discard(alarm_id)
+
+ALARM_INDEX = AlarmIndex()
+
+def new_alarm_id():
+    return uuid.uuid4().hex[:12]
+
+#################################
+# 🧷 알람 상태 저장소 (쿨다운/횟수, 재시작 후 복원)
+#################################
+
+class AlertState:
+    __slots__ = ("last_sent", "count", "last_seen")
+
+    def __init__(self, last_sent, count, last_seen):
+        self.last_sent = last_sent
+        self.count = count
+        self.last_seen = last_seen
+
+class AlertStore:
+    # 알람id → AlertState. 리셋된 알람은 항목 자체를 지움 (울린 알람만 보관)
+    def __init__(self):
+        self.states = {}
+        self.dirty = False
+        self.dropped = set()  # 지난 저장 이후 지운 알람id (샤드 저장 시 DB에서도 지움)
+
+    def get(self, alarm_id):
+        return self.states.get(alarm_id)
+
+    def fire(self, alarm_id, now, count):
+        st = self.states.get(alarm_id)
+        if st is None:
+            self.states[alarm_id] = AlertState(now, count, now)
+            ALARM_INDEX.set_active(alarm_id, True)
+        else:
+            st.last_sent = now
+            st.count = count
+            st.last_seen = now
+        self.dirty = True
+
+    def seen(self, alarm_id, now):
+        st = self.states.get(alarm_id)
+        if st is not None:
+            st.last_seen = now
+
+    def reset(self, alarm_id):
+        if self.states.pop(alarm_id, None) is not None:
+            ALARM_INDEX.set_active(alarm_id, False)
+            self.dropped.add(alarm_id)
+            self.dirty = True
+
+    def remove(self, alarm_id):
+        # 알람 삭제 시 (인덱스에서는 이미 빠진 상태)
+        if self.states.pop(alarm_id, None) is not None:
+            self.dropped.add(alarm_id)
+            self.dirty = True
+
+    def sweep(self, now):
+        # 삭제된 알람 / 오래 평가 안 된 상태 정리
+        stale = [
+            aid for aid, st in self.states.items()
+            if aid not in ALARM_INDEX.alarms or now - st.last_seen > ALERT_IDLE_SEC
+        ]
+        for aid in stale:
+            self.reset(aid)
+        return len(stale)
+
+    def save(self):
+        owned = None
+        if SHARD_COUNT > 1:
+            owned = set(ALARM_INDEX.alarms) | set(self.states) | self.dropped
+        save_alert_state([
+            (aid, st.last_sent, st.count, st.last_seen) for aid, st in self.states.items()
+        ], owned)
+        self.dropped.clear()
+        self.dirty = False
+
+    def restore(self):
+        for aid, last_sent, count, last_seen in load_alert_state():
+            if aid in ALARM_INDEX.alarms:
+                self.states[aid] = AlertState(last_sent, count, last_seen)
+                ALARM_INDEX.set_active(aid, True)
+        self.sweep(_time.time())
+        self.dirty = False
+
+ALERT_STATE = AlertStore()
+
+async def alert_state_loop():
+    while True:
+        await asyncio.sleep(ALERT_SAVE_SEC)
+        try:
+            ALERT_STATE.sweep(_time.time())
+            if ALERT_STATE.dirty:
+                ALERT_STATE.save()
+        except Exception as e:
+            print(f"[알람 상태 저장 오류] {e}")
+
+#################################
+# 🔔 알람 체크 루프 (2번 울리고 쿨다운)
+#################################
+
+def snapshot_gaps(snapshot, keys):
+    # → {그룹키: (가격차, 고가, 저가)} 양쪽 가격이 다 있는 그룹만
+    gaps = {}
+    for key in keys:
+        coin, ex_high, ex_low = key
+        high = snapshot.get(ex_high, {}).get(coin)
+        low = snapshot.get(ex_low, {}).get(coin)
 
         if high is None or low is None:
-            print(f"[가격 조회 실패] {a['coin']} high={high} low={low}")
+            # 차단기가 열린 거래소는 이미 한 번 로그를 남겼으므로 그룹마다 찍지 않음
+            if not (circuit_open(ex_high) or circuit_open(ex_low)):
+                print(f"[가격 조회 실패] {coin} high={high} low={low}")
             continue
 
-        gap = round(high - low, 8)
-        threshold = a["diff"]
+        gaps[key] = (round(high - low, 8), high, low)
+    return gaps
 
-        if night_data.get(str(a["chat_id"]), False) and now_night:
-            threshold *= 2
+async def evaluate_alarms(app, snapshot, keys=None, now=None):
+    # snapshot: {거래소: {코인: 가격}} — REST 스냅샷 / 스트림 가격장부 / 버스로 받은 스냅샷 공용
+    # keys: 평가할 그룹 (None이면 전체), now: 가상 시각 (리플레이용)
+    # → {그룹키: (가격차, 저가)} 평가된 그룹만
+    now = _time.time() if now is None else now
+    now_night = is_night_time(now)
+    seen = {}
+
+    gaps = snapshot_gaps(snapshot, list(ALARM_INDEX.groups if keys is None else keys))
+    for key, (gap, high, low) in gaps.items():
+        seen[key] = (gap, low)
+        fired, reset = ALARM_INDEX.crossed(key, gap, now_night)
 
         # 차익 사라지면 완전 리셋
-        if gap < threshold:
-            ALERT_STATE[key] = {"last_sent": 0, "active": False, "count": 0}
-            continue
+        for aid in reset:
+            ALERT_STATE.reset(aid)
 
-        count = state.get("count", 0)
-        last_sent = state.get("last_sent", 0)
+        for a in fired:
+            _fire_alarm(a, high, low, gap, now)
 
-        # 2번 미만이면 바로 전송
-        if count < 2:
-            pass
-        else:
-            # 2번 울린 이후엔 쿨다운 체크
-            if now - last_sent < COOLDOWN_SEC:
+    return seen
+
+def alarm_wait(count):
+    # 지금까지 울린 횟수 → 다음 전송까지 최소 간격
+    # 처음은 바로, 두 번째는 CHECK_INTERVAL 뒤, 2번 울린 이후엔 COOLDOWN_SEC
+    if count == 0:
+        return 0
+    return CHECK_INTERVAL if count < 2 else COOLDOWN_SEC
+
+def alarm_next_count(count):
+    # 쿨다운 끝나면 count 리셋 → 다시 2번 울림
+    return 1 if count >= 2 else count + 1
+
+def net_profit(a, high, low, gap):
+    buy_fee = low * FEE_RATE.get(a["ex_low"], 0)
+    sell_fee = high * FEE_RATE.get(a["ex_high"], 0)
+    return round(gap - buy_fee - sell_fee, 8)
+
+def _fire_alarm(a, high, low, gap, now):
+    key = a["id"]
+    state = ALERT_STATE.get(key)
+
+    count = state.count if state else 0
+    last_sent = state.last_sent if state else 0
+
+    if now - last_sent < alarm_wait(count):
+        ALERT_STATE.seen(key, now)
+        return
+
+    ALERT_STATE.fire(key, now, alarm_next_count(count))
+
+    DISPATCHER.enqueue(
+        a["chat_id"],
+        f"🚨 차익 발생 [{a['coin']}]\n"
+        f"{a['kr_high']} : {fmt(high)}원\n"
+        f"{a['kr_low']} : {fmt(low)}원\n"
+        f"📈 가격차 : {fmt(gap)}원\n"
+        f"💸 순이익 : {fmt(net_profit(a, high, low, gap))}원"
+    )
+
+#################################
+# ⏱ 적응형 폴링 스케줄러 (그룹별 주기)
+#################################
+
+class PollScheduler:
+    # 그룹별 다음 확인 시각 = 가장 가까운 임계값까지 거리 ÷ 최근 변동 속도 기준
+    def __init__(self):
+        self.state = {}  # 그룹키 → {"next", "interval", "t", "rel", "vol"}
+
+    def due(self, now):
+        for key in list(self.state):
+            if key not in ALARM_INDEX.groups:
+                del self.state[key]
+        # 새 그룹(/set 직후)은 기록이 없으므로 바로 확인
+        return [
+            key for key in ALARM_INDEX.groups
+            if self.state.get(key, {}).get("next", 0) <= now
+        ]
+
+    def update(self, keys, seen, now, now_night):
+        for key in keys:
+            # 조회하는 동안 마지막 알람이 삭제됐거나 알람 목록을 다시 받았으면 그룹이 없음
+            g = ALARM_INDEX.groups.get(key)
+            if g is None:
+                self.state.pop(key, None)
                 continue
-            # 쿨다운 끝나면 count 리셋 → 다시 2번 울림
-            count = 0
 
-        ALERT_STATE[key] = {"last_sent": now, "active": True, "count": count + 1}
+            s = self.state.get(key)
+            if key not in seen:
+                # 가격 조회 실패 → 기본 주기로 재시도
+                interval = CHECK_INTERVAL
+                if s:
+                    s.update(next=now + interval, interval=interval)
+                else:
+                    self.state[key] = {"next": now + interval, "interval": interval, "t": now, "rel": None, "vol": None}
+                continue
 
-        buy_fee = low * FEE_RATE.get(a["ex_low"], 0)
-        sell_fee = high * FEE_RATE.get(a["ex_high"], 0)
-        net_profit = round(gap - buy_fee - sell_fee, 8)
+            gap, price = seen[key]
+            rel = gap / price
+            vol = None
+            if s and s["rel"] is not None and now > s["t"]:
+                speed = abs(rel - s["rel"]) / (now - s["t"])
+                vol = speed if s["vol"] is None else ALARM_VOL_ALPHA * speed + (1 - ALARM_VOL_ALPHA) * s["vol"]
+
+            if vol is None:
+                interval = CHECK_INTERVAL
+            else:
+                dist = ALARM_INDEX.distance(key, gap, now_night) / price
+                ttc = dist / max(vol, ALARM_VOL_FLOOR)
+                interval = min(max(ttc / ALARM_HORIZON, ALARM_TICK_SEC), ALARM_COLD_SEC)
+
+            # 임계값을 넘은 알람(두 번째 알림/쿨다운 재알림 대상)이 있으면 기본 주기보다 늦추지 않음
+            # (fetcher 역할은 울림 상태를 모르므로 가격차로만 판단)
+            lst = g["night"] if now_night else g["day"]
+            if lst and lst[0][0] <= gap:
+                interval = min(interval, CHECK_INTERVAL)
+
+            self.state[key] = {"next": now + interval, "interval": interval, "t": now, "rel": rel, "vol": vol}
+
+    def tiers(self):
+        hot = warm = cold = 0
+        for s in self.state.values():
+            if s["interval"] <= ALARM_TICK_SEC * 2:
+                hot += 1
+            elif s["interval"] >= ALARM_COLD_SEC * 0.66:
+                cold += 1
+            else:
+                warm += 1
+        return {"hot": hot, "warm": warm, "cold": cold}
+
+POLL_SCHED = PollScheduler()
+
+async def poll_tick(app):
+    # 이번 박자에 도래한 그룹만 조회/평가
+    now = _time.time()
+    due = POLL_SCHED.due(now)
+    if not due:
+        return
+    snapshot = await build_price_snapshot(due, max_age=ALARM_TICK_SEC)
+    if ROLE == "fetcher":
+        # 평가는 evaluator들이 → 스냅샷만 발행
+        seen = {key: (gap, low) for key, (gap, _, low) in snapshot_gaps(snapshot, due).items()}
+        publish_snapshot(snapshot, due)
+    else:
+        seen = await evaluate_alarms(app, snapshot, due)
+    POLL_SCHED.update(due, seen, _time.time(), is_night_time())
+
+async def alarm_loop(app):
+    # 고정 박자(ALARM_TICK_SEC) — 틱 소요시간만큼 밀리지 않도록 절대 시각 기준
+    next_t = _time.monotonic()
+    while True:
+        next_t += ALARM_TICK_SEC
+        now = _time.monotonic()
+        if next_t < now:
+            # 밀린 박자는 건너뜀
+            missed = int((now - next_t) / ALARM_TICK_SEC) + 1
+            next_t += missed * ALARM_TICK_SEC
+            METRICS.inc("alarm_tick_overruns_total", value=missed)
+        await asyncio.sleep(next_t - now)
 
         try:
-            await app.bot.send_message(
-                chat_id=a["chat_id"],
-                text=(
-                    f"🚨 차익 발생 [{a['coin']}]\n"
-                    f"{a['kr_high']} : {fmt(high)}원\n"
-                    f"{a['kr_low']} : {fmt(low)}원\n"
-                    f"📈 가격차 : {fmt(gap)}원\n"
-                    f"💸 순이익 : {fmt(net_profit)}원"
-                )
-            )
+            # 스트림이 살아있으면 이벤트 기반으로 처리되므로 REST 폴링 생략
+            if not stream_alive():
+                t = _time.monotonic()
+                await poll_tick(app)
+                METRICS.observe("alarm_tick_seconds", _time.monotonic() - t)
         except Exception as e:
-            print(f"[알람 전송 실패] {a['coin']} → {e}")
+            METRICS.inc("alarm_loop_errors_total")
+            print(f"[알람 루프 오류] {e}")
+
+
+#################################
+# 📡 실시간 시세 스트림 (WebSocket, STREAM_MODE=1)
+#################################
+
+PRICE_BOOK = {ex: {} for ex in STREAM_WS_URLS}
+STREAM_CONNECTED = {ex: False for ex in STREAM_WS_URLS}
+
+_STREAM_VERSION = 0
+_STREAM_INDEX = {"version": -1, "coins": {}}
+_STREAM_LAST_EVAL = {}
+_STREAM_PENDING = set()
+_STREAM_TASKS = set()   # 진행 중인 평가 태스크 (참조 안 잡으면 도중에 GC 될 수 있음)
+_STREAM_RECHECK = {}    # 코인 → 재평가 타이머
+
+def notify_alarms_changed():
+    # /set, /delete, /night 후 호출 → 구독 코인이 바뀌었으면 스트림 재구독
+    # sender 역할이면 fetcher/evaluator 에게도 알림 (DB에서 다시 읽음)
+    global _STREAM_VERSION
+    _STREAM_VERSION += 1
+    if ROLE == "sender":
+        BUS.publish("alarms", {})
+
+def _stream_index():
+    if _STREAM_INDEX["version"] != _STREAM_VERSION:
+        coins = {ex: set() for ex in STREAM_WS_URLS}
+        for coin, ex_high, ex_low in ALARM_INDEX.groups:
+            for ex in (ex_high, ex_low):
+                if ex in coins:
+                    coins[ex].add(coin)
+        _STREAM_INDEX.update(version=_STREAM_VERSION, coins=coins)
+    return _STREAM_INDEX
+
+def stream_alive():
+    if not STREAM_MODE:
+        return False
+    coins = _stream_index()["coins"]
+    return all(STREAM_CONNECTED[ex] for ex in coins if coins[ex])
+
+def _stream_subscribe_msg(exchange, coins):
+    if exchange == "upbit":
+        return json.dumps([
+            {"ticket": str(uuid.uuid4())},
+            {"type": "ticker", "codes": [f"KRW-{c}" for c in coins]},
+        ])
+    return json.dumps({
+        "type": "ticker",
+        "symbols": [f"{c}_KRW" for c in coins],
+        "tickTypes": ["MID"],
+    })
+
+def _stream_parse(exchange, raw):
+    # → (코인, 가격) 또는 None
+    try:
+        d = json.loads(raw)
+        if exchange == "upbit":
+            if d.get("type") != "ticker":
+                return None
+            return d["code"].replace("KRW-", ""), float(d["trade_price"])
+        if d.get("type") != "ticker":
+            return None
+        c = d["content"]
+        return c["symbol"].replace("_KRW", ""), float(c["closePrice"])
+    except:
+        return None
+
+def _on_stream_price(app, exchange, coin, price):
+    book = PRICE_BOOK[exchange]
+    if price <= 0:
+        return
+    PRICE_CACHE.put(exchange, coin, price)
+    if book.get(coin) == price:
+        return
+    book[coin] = price
+
+    _queue_stream_eval(app, coin)
+
+def _queue_stream_eval(app, coin):
+    # 같은 코인은 STREAM_EVAL_MIN_SEC 에 한 번만 평가 (연속 체결로 2연발 방지)
+    if coin in _STREAM_PENDING:
+        return
+    _STREAM_PENDING.add(coin)
+    delay = max(0, _STREAM_LAST_EVAL.get(coin, 0) + STREAM_EVAL_MIN_SEC - _time.time())
+    asyncio.get_running_loop().call_later(delay, _start_stream_eval, app, coin)
+
+def _start_stream_eval(app, coin):
+    task = asyncio.create_task(_stream_eval(app, coin))
+    _STREAM_TASKS.add(task)
+    task.add_done_callback(_STREAM_TASKS.discard)
+
+async def _stream_eval(app, coin):
+    _STREAM_PENDING.discard(coin)
+    _STREAM_LAST_EVAL[coin] = _time.time()
+    ready = [
+        key for key in ALARM_INDEX.by_coin.get(coin, ())
+        if coin in PRICE_BOOK.get(key[1], {}) and coin in PRICE_BOOK.get(key[2], {})
+    ]
+    if ready:
+        try:
+            if ROLE == "fetcher":
+                publish_snapshot({ex: {coin: PRICE_BOOK[ex][coin]} for ex in PRICE_BOOK if coin in PRICE_BOOK[ex]}, ready)
+            else:
+                await evaluate_alarms(app, PRICE_BOOK, ready)
+        except Exception as e:
+            print(f"[스트림 알람 오류] {coin} → {e}")
+    _schedule_stream_recheck(app, coin, ready)
+
+def _stream_recheck_delay(coin, keys, now):
+    # 임계값을 넘은 채 체결이 멈추면 두 번째 알람/쿨다운 끝을 놓침 → 다음 평가까지 남은 초 (None: 필요 없음)
+    now_night = is_night_time(now)
+    delay = None
+    for key in keys:
+        gap = round(PRICE_BOOK[key[1]][coin] - PRICE_BOOK[key[2]][coin], 8)
+        fired, _ = ALARM_INDEX.crossed(key, gap, now_night)
+        for a in fired:
+            st = ALERT_STATE.get(a["id"])
+            if ROLE == "fetcher":
+                # 울림 상태는 evaluator 에 있음 → 기본 주기로 스냅샷만 다시 보냄
+                wait = CHECK_INTERVAL
+            else:
+                wait = st.last_sent + alarm_wait(st.count) - now if st else 0
+            delay = wait if delay is None else min(delay, wait)
+    return delay
+
+def _schedule_stream_recheck(app, coin, keys):
+    old = _STREAM_RECHECK.pop(coin, None)
+    if old is not None:
+        old.cancel()
+    delay = _stream_recheck_delay(coin, keys, _STREAM_LAST_EVAL[coin])
+    if delay is not None:
+        _STREAM_RECHECK[coin] = asyncio.get_running_loop().call_later(
+            max(delay, STREAM_EVAL_MIN_SEC), _stream_recheck, app, coin
+        )
+
+def _stream_recheck(app, coin):
+    _STREAM_RECHECK.pop(coin, None)
+    # 스트림이 끊겼으면 가격장부가 낡았음 → REST 폴링에 맡김
+    if stream_alive():
+        _queue_stream_eval(app, coin)
+
+async def price_stream(app, exchange):
+    url = STREAM_WS_URLS[exchange]
+    backoff = 1
 
-async def alarm_loop(app):
     while True:
+        index = _stream_index()
+        coins = sorted(index["coins"][exchange])
+
+        if not coins:
+            STREAM_CONNECTED[exchange] = False
+            await asyncio.sleep(1)
+            continue
+
         try:
-            await check_alarms(app)
+            async with websockets.connect(url, ping_interval=20, open_timeout=10) as ws:
+                await ws.send(_stream_subscribe_msg(exchange, coins))
+
+                # (재)연결 직후 REST로 가격장부 채워두기 (체결 없는 코인 대비)
+                if exchange == "upbit":
+                    seed = await get_prices("upbit", coins, max_age=0)
+                else:
+                    seed = await get_all_prices("bithumb", max_age=0)
+                PRICE_BOOK[exchange].update({c: seed[c] for c in coins if c in seed})
+
+                STREAM_CONNECTED[exchange] = True
+                backoff = 1
+                print(f"[스트림 연결] {exchange} {len(coins)}개 코인")
+
+                while sorted(_stream_index()["coins"][exchange]) == coins:
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=1)
+                    except asyncio.TimeoutError:
+                        continue
+                    parsed = _stream_parse(exchange, raw)
+                    if parsed:
+                        _on_stream_price(app, exchange, *parsed)
+
+                # 구독 코인 변경 → 루프 처음으로 돌아가 재구독
+
+        except asyncio.CancelledError:
+            STREAM_CONNECTED[exchange] = False
+            raise
         except Exception as e:
-            print(f"[알람 루프 오류] {e}")
-        await asyncio.sleep(CHECK_INTERVAL)
+            STREAM_CONNECTED[exchange] = False
+            print(f"[스트림 끊김] {exchange} → {e} ({backoff}초 후 재연결, 그동안 REST 폴링)")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+_GAP_HEAP = []  # (next_run, chat_id)
+_GAP_WAKE = asyncio.Event()
 
+def schedule_gap_auto(cid, next_run):
+    heapq.heappush(_GAP_HEAP, (next_run, str(cid)))
+    _GAP_WAKE.set()
 
 async def gap_auto_loop():
+    # next_run 기준 힙 → 가장 가까운 구독 시각까지만 잠듦
+    for cid, cfg in load_gap_auto().items():
+        if cfg.get("enabled", False):
+            heapq.heappush(_GAP_HEAP, (cfg.get("next_run", 0), cid))
+
     while True:
-        await asyncio.sleep(60)
         try:
+            _GAP_WAKE.clear()
+            wait = _GAP_HEAP[0][0] - _time.time() if _GAP_HEAP else None
+            if wait is None or wait > 0:
+                try:
+                    await asyncio.wait_for(_GAP_WAKE.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # 비슷한 시각(GAP_AUTO_BATCH_SEC 이내)에 도래한 구독은 한 번에 처리
             now = _time.time()
             data = load_gap_auto()
-            changed = False
-
-            for cid, cfg in data.items():
-                if not cfg.get("enabled", False):
+            due = {}
+            while _GAP_HEAP and _GAP_HEAP[0][0] <= now + GAP_AUTO_BATCH_SEC:
+                next_run, cid = heapq.heappop(_GAP_HEAP)
+                cfg = data.get(cid)
+                # /gap off 됐거나 재설정돼서 예전 예약이면 버림
+                if not cfg or not cfg.get("enabled", False) or cfg.get("next_run", 0) != next_run:
                     continue
+                due[cid] = next_run
+
+            if not due:
+                continue
+
+            # 거래소쌍별로 시세 한 번씩
+            pairs = list({tuple(data[cid].get("pair", DEFAULT_GAP_PAIR)) for cid in due})
+            markets = dict(zip(pairs, await asyncio.gather(*(fetch_gap_market(p) for p in pairs))))
+            views = {}  # (거래소쌍, 임계값) → 임계값 넘는 코인 전부의 줄 (변화 감지 구독자끼리 공유)
 
-                next_run = cfg.get("next_run", 0)
-                if now < next_run:
+            # 시세 받는 동안 /gap off 또는 /gap on 재설정이 들어왔을 수 있음 → 지금 설정으로 다시 확인
+            data = load_gap_auto()
+            updated = {}
+            for cid, next_run in due.items():
+                cfg = data.get(cid)
+                if not cfg or not cfg.get("enabled", False) or cfg.get("next_run", 0) != next_run:
                     continue
+                updated[cid] = cfg
 
-                interval_sec = cfg.get("interval_min", 30) * 60
-                threshold = cfg.get("threshold", 1.0)
+                if cfg.get("next_run", 0):
+                    METRICS.observe("gap_auto_lag_seconds", max(0, now - cfg["next_run"]))
+                cfg["next_run"] = now + cfg.get("interval_min", 30) * 60
+                heapq.heappush(_GAP_HEAP, (cfg["next_run"], cid))
 
-                cfg["next_run"] = now + interval_sec
-                changed = True
+                pair = tuple(cfg.get("pair", DEFAULT_GAP_PAIR))
+                threshold = cfg.get("threshold", 1.0)
+                market = markets[pair]
+                if market is None:
+                    # 시세 조회 실패 → 이번 회차는 건너뜀 (구독자마다 다시 조회하지 않고 지난 발송 기준도 유지)
+                    continue
 
+                rows = views.get((pair, threshold))
+                if rows is None and GAP_AUTO_DIFF:
+                    rows = views[(pair, threshold)] = _gap_lines(market, threshold, True, limit=None)
                 try:
-                    await _send_gap_result(int(cid), threshold, reply_to=None)
+                    # 지난번 보낸 결과가 있으면 달라진 것만, 처음(/gap on 직후)은 전체
+                    if GAP_AUTO_DIFF and cfg.get("last") is not None:
+                        cfg["last"] = _send_gap_diff(int(cid), threshold, market, rows, cfg["last"])
+                    else:
+                        await _send_gap_result(int(cid), threshold, reply_to=None, market=market)
+                        if GAP_AUTO_DIFF:
+                            cfg["last"] = gap_fingerprint(rows)
                 except Exception as e:
                     print(f"[gap 자동 알람 오류] chat_id={cid} → {e}")
 
-            if changed:
-                save_gap_auto(data)
+            save_gap_auto(updated)
 
         except Exception as e:
             print(f"[gap 자동 루프 오류] {e}")
+            await asyncio.sleep(5)
 
 
 #################################
-# 전역 app 참조 (자동 알람 전송용)
+# 📼 시세 기록 (고정폭 mmap 세그먼트 + 1분/1시간 롤업)
 #################################
-_APP = None
+
+# 원본 틱: 코인별 HISTORY_PAIR 두 거래소 가격 + 괴리율(%) = (a - b) / b
+RAW_DTYPE = np.dtype([
+    ("ts", "<u4"), ("coin", "<u2"),
+    (HISTORY_PAIR[0], "<f8"), (HISTORY_PAIR[1], "<f8"), ("gap", "<f4"),
+])
+# 롤업: 구간 시작 시각 + 괴리율 최소/최대/마지막 + 마지막 가격
+ROLLUP_DTYPE = np.dtype([
+    ("ts", "<u4"), ("coin", "<u2"),
+    ("min", "<f4"), ("max", "<f4"), ("last", "<f4"),
+    (HISTORY_PAIR[0], "<f8"), (HISTORY_PAIR[1], "<f8"),
+])
+HISTORY_KINDS = {
+    # 종류 → (dtype, 구간 초, 보관 일수)
+    "raw": (RAW_DTYPE, 0, HISTORY_RAW_DAYS),
+    "1m": (ROLLUP_DTYPE, 60, HISTORY_1M_DAYS),
+    "1h": (ROLLUP_DTYPE, 3600, HISTORY_1H_DAYS),
+}
+SEG_MAGIC = b"GTS1"
+SEG_HEADER = 16  # magic(4) + 레코드 크기(4) + 레코드 수(8)
+
+class Segment:
+    # 하루치 고정폭 레코드 파일. 헤더의 레코드 수까지만 유효, 모자라면 2배로 늘림
+    def __init__(self, path, dtype, capacity=4096):
+        self.path = path
+        self.dtype = dtype
+        new = not os.path.exists(path)
+        self.f = open(path, "w+b" if new else "r+b")
+        if new:
+            self.f.write(struct.pack("<4sIQ", SEG_MAGIC, dtype.itemsize, 0))
+            self.f.truncate(SEG_HEADER + capacity * dtype.itemsize)
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        magic, size, self.count = struct.unpack_from("<4sIQ", self.mm, 0)
+        if magic != SEG_MAGIC or size != dtype.itemsize:
+            self.close()
+            raise ValueError(f"세그먼트 형식 불일치: {path}")
+
+    def capacity(self):
+        return (len(self.mm) - SEG_HEADER) // self.dtype.itemsize
+
+    def refresh(self):
+        # 다른 프로세스가 쓰는 파일이면 그 사이 늘어난 레코드 수/파일 크기를 다시 읽음
+        if os.fstat(self.f.fileno()).st_size != len(self.mm):
+            self.mm.close()
+            self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.count = struct.unpack_from("<Q", self.mm, 8)[0]
+
+    def append(self, rows):
+        need = self.count + len(rows)
+        if need > self.capacity():
+            size = SEG_HEADER + max(need, self.capacity() * 2) * self.dtype.itemsize
+            self.mm.close()
+            self.f.truncate(size)
+            self.mm = mmap.mmap(self.f.fileno(), 0)
+        start = SEG_HEADER + self.count * self.dtype.itemsize
+        self.mm[start:start + rows.nbytes] = rows.tobytes()
+        self.count = need
+        struct.pack_into("<Q", self.mm, 8, self.count)
+
+    def select(self, coin_id, t0, t1):
+        # 레코드는 시각순으로 쌓이므로 시각 구간은 이진탐색, 코인은 마스크
+        view = np.frombuffer(self.mm, self.dtype, self.count, SEG_HEADER)
+        lo, hi = np.searchsorted(view["ts"], [t0, t1], side="left")
+        part = view[lo:hi]
+        # coin_id None → 전체 코인
+        out = (part if coin_id is None else part[part["coin"] == coin_id]).copy()
+        del view, part  # mmap 크기 변경 전에 버퍼 참조 해제
+        return out
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+def _day(ts):
+    return _time.strftime("%Y%m%d", _time.gmtime(ts))
+
+class HistoryRecorder:
+    # 쓰기는 기록 루프의 작업 스레드, 읽기는 /history → 세그먼트 접근은 락으로 보호
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()  # (종류, 날짜) → Segment (최근 사용 순, 개수 제한)
+        self.coins = None    # 코인 → 번호 (coins.json, 추가만 함)
+        self.names = []
+        self.open = {"1m": {}, "1h": {}}  # 종류 → {코인번호: 아직 안 닫힌 롤업 행}
+        self.last_seen = {}  # 코인 → 마지막으로 기록한 가격의 조회시각
+
+    def _load_coins(self):
+        for kind in HISTORY_KINDS:
+            os.makedirs(f"{self.root}/{kind}", exist_ok=True)
+        self.names = _read_json(f"{self.root}/coins.json", [])
+        self.coins = {c: i for i, c in enumerate(self.names)}
+
+    def coin_id(self, coin, create=False):
+        if self.coins is None or (coin not in self.coins and not create):
+            # 읽기만 하는 프로세스(cluster 의 sender)는 기록 중 추가된 코인을 파일에서 다시 읽음
+            self._load_coins()
+        cid = self.coins.get(coin)
+        if cid is None and create:
+            cid = self.coins[coin] = len(self.names)
+            self.names.append(coin)
+            tmp = f"{self.root}/coins.json.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.names, f)
+            os.replace(tmp, f"{self.root}/coins.json")
+        return cid
+
+    def _segment(self, kind, day, create):
+        seg = self.segments.get((kind, day))
+        if seg is None:
+            path = f"{self.root}/{kind}/{day}.bin"
+            if not create and not os.path.exists(path):
+                return None
+            seg = self.segments[(kind, day)] = Segment(path, HISTORY_KINDS[kind][0])
+            while len(self.segments) > HISTORY_OPEN_SEGMENTS:
+                self.segments.popitem(last=False)[1].close()
+        self.segments.move_to_end((kind, day))
+        return seg
+
+    def write(self, ts, ticks):
+        # ts: 기록 틱 시각, ticks: [(코인, 가격 a, 가격 b)] (HISTORY_PAIR 순서)
+        with self.lock:
+            # 끝난 구간은 틱마다 전부 닫음 → 롤업 파일도 시각순으로 쌓임
+            closed = {}
+            for kind, rows in self.open.items():
+                size = HISTORY_KINDS[kind][1]
+                for cid in [cid for cid, cur in rows.items() if cur["ts"] + size <= ts]:
+                    cur = rows.pop(cid)
+                    closed.setdefault((kind, _day(cur["ts"])), []).append(cur)
+            self._flush(closed)
+
+            if not ticks:
+                return
+            raw = np.zeros(len(ticks), RAW_DTYPE)
+            for i, (coin, a, b) in enumerate(ticks):
+                raw[i] = (ts, self.coin_id(coin, create=True), a, b, (a - b) / b * 100)
+            self._segment("raw", _day(ts), True).append(raw)
+
+            for row in raw:
+                for kind in ("1m", "1h"):
+                    self._roll(kind, ts, row)
+
+    def _roll(self, kind, ts, row):
+        cid = int(row["coin"])
+        g = float(row["gap"])
+        cur = self.open[kind].get(cid)
+        if cur is None:
+            size = HISTORY_KINDS[kind][1]
+            cur = self.open[kind][cid] = {
+                "ts": ts - ts % size, "coin": cid, "min": g, "max": g, "last": g,
+            }
+        cur["min"] = min(cur["min"], g)
+        cur["max"] = max(cur["max"], g)
+        cur["last"] = g
+        for ex in HISTORY_PAIR:
+            cur[ex] = float(row[ex])
+
+    def _flush(self, closed):
+        for (kind, day), rows in closed.items():
+            arr = np.array([tuple(r[k] for k in ROLLUP_DTYPE.names) for r in rows], ROLLUP_DTYPE)
+            arr.sort(order="ts", kind="stable")
+            self._segment(kind, day, True).append(arr)
+
+    def flush_open(self):
+        # 종료 시 아직 안 닫힌 구간도 기록 (재시작 후 같은 구간이 또 생기면 조회 때 합침)
+        with self.lock:
+            closed = {}
+            for kind, rows in self.open.items():
+                for cur in rows.values():
+                    closed.setdefault((kind, _day(cur["ts"])), []).append(cur)
+                rows.clear()
+            self._flush(closed)
+
+    def _select(self, kind, coin_id, t0, t1):
+        # 일자 파일들에서 [t0, t1) 구간 → 파일 순서대로 이어붙일 조각들
+        parts = []
+        day = t0 - t0 % 86400
+        while day <= t1:
+            seg = self._segment(kind, _day(day), False)
+            if seg is not None:
+                seg.refresh()
+                parts.append(seg.select(coin_id, t0, t1))
+            day += 86400
+        return parts
+
+    def query(self, coin, t0, t1, kind):
+        # → 구간 시작 시각순 롤업 배열 (닫힌 구간 + 진행 중인 구간)
+        with self.lock:
+            cid = self.coin_id(coin)
+            if cid is None:
+                return np.zeros(0, ROLLUP_DTYPE)
+            parts = self._select(kind, cid, t0, t1)
+            cur = self.open[kind].get(cid)
+            if cur is not None:
+                if t0 <= cur["ts"] < t1:
+                    parts.append(np.array([tuple(cur[k] for k in ROLLUP_DTYPE.names)], ROLLUP_DTYPE))
+            else:
+                # 이 프로세스가 기록하지 않음(cluster 의 sender) → 아직 안 닫힌 구간은 원본 틱으로 계산
+                # 직전 구간도 포함 (기록 쪽이 구간 경계 직후 아직 닫지 않았을 수 있음, 겹치면 조회 때 합침)
+                size = HISTORY_KINDS[kind][1]
+                start = max(t0, t1 - t1 % size - size)
+                raw = self._select("raw", cid, start, t1)
+                if raw:
+                    parts.append(_rollup_raw(np.concatenate(raw), size))
+        rows = np.concatenate(parts) if parts else np.zeros(0, ROLLUP_DTYPE)
+        rows.sort(order="ts", kind="stable")
+        return _merge_rollups(rows)
+
+    def raw(self, t0, t1):
+        # → (전체 코인 원본 틱 시각순, 코인 이름 목록) 리플레이용
+        with self.lock:
+            self._load_coins()
+            parts = self._select("raw", None, t0, t1)
+            names = list(self.names)
+        rows = np.concatenate(parts) if parts else np.zeros(0, RAW_DTYPE)
+        return rows, names
+
+    def prune(self, now):
+        # 보관 기간 지난 일자 파일 삭제
+        with self.lock:
+            for kind, (_, _, days) in HISTORY_KINDS.items():
+                cutoff = _day(now - days * 86400)
+                folder = f"{self.root}/{kind}"
+                if not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    day = name.split(".")[0]
+                    if day < cutoff:
+                        seg = self.segments.pop((kind, day), None)
+                        if seg is not None:
+                            seg.close()
+                        os.remove(f"{folder}/{name}")
+                        print(f"[시세 기록 정리] {kind}/{name}")
+
+def _rollup_raw(raw, size):
+    # 한 코인 원본 틱(시각순) → 구간별 롤업
+    starts = raw["ts"] - raw["ts"] % size
+    out = []
+    for start in np.unique(starts):
+        part = raw[starts == start]
+        g = part["gap"]
+        out.append((start, part["coin"][0], g.min(), g.max(), g[-1]) + tuple(part[ex][-1] for ex in HISTORY_PAIR))
+    return np.array(out, ROLLUP_DTYPE)
+
+def _merge_rollups(rows):
+    # 재시작 전후로 같은 구간이 두 번 기록됐으면 하나로 합침
+    if len(rows) < 2 or not (np.diff(rows["ts"].astype(np.int64)) == 0).any():
+        return rows
+    out = [rows[0].copy()]
+    for r in rows[1:]:
+        if r["ts"] == out[-1]["ts"]:
+            m = out[-1]
+            m["min"] = min(m["min"], r["min"])
+            m["max"] = max(m["max"], r["max"])
+            for k in ("last",) + HISTORY_PAIR:
+                m[k] = r[k]
+        else:
+            out.append(r.copy())
+    return np.array(out, ROLLUP_DTYPE)
+
+HISTORY = HistoryRecorder(HISTORY_DIR)
+
+def _history_ticks():
+    # 지난 틱 이후 가격이 갱신된 코인 중 양쪽 가격이 비슷한 시각인 것만
+    coins, PRICE_CACHE.dirty = PRICE_CACHE.dirty, set()
+    ticks = []
+    for coin in sorted(coins):
+        a = PRICE_CACHE.entries.get((HISTORY_PAIR[0], coin))
+        b = PRICE_CACHE.entries.get((HISTORY_PAIR[1], coin))
+        if a is None or b is None or abs(a[1] - b[1]) > HISTORY_PAIR_SKEW:
+            continue
+        seen = max(a[1], b[1])
+        if seen <= HISTORY.last_seen.get(coin, 0):
+            continue
+        HISTORY.last_seen[coin] = seen
+        ticks.append((coin, a[0], b[0]))
+    return ticks
+
+async def history_loop():
+    # 가격 조회 경로(PRICE_CACHE)에서 갱신된 코인만 모아 작업 스레드에서 기록
+    # → 알람 루프는 기다리지 않음
+    last_prune = 0
+    while True:
+        await asyncio.sleep(HISTORY_TICK_SEC)
+        try:
+            ticks = _history_ticks()
+            await asyncio.to_thread(HISTORY.write, int(_time.time()), ticks)
+            METRICS.inc("history_ticks_total", value=len(ticks))
+            if _time.time() - last_prune > 3600:
+                last_prune = _time.time()
+                await asyncio.to_thread(HISTORY.prune, last_prune)
+        except Exception as e:
+            print(f"[시세 기록 오류] {e}")
+
+SPARK = "▁▂▃▄▅▆▇█"
+
+def _parse_span(text):
+    # "30m" / "24h" / "7d" → 초
+    units = {"m": 60, "h": 3600, "d": 86400}
+    text = text.lower()
+    if not text or text[-1] not in units:
+        raise ValueError
+    n = float(text[:-1])
+    if n <= 0:
+        raise ValueError
+    return int(n * units[text[-1]])
+
+def _kst(ts):
+    return (datetime.utcfromtimestamp(ts) + timedelta(hours=9)).strftime("%m/%d %H:%M")
+
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("사용법: /history ETH 24h [퍼센트]\n예) /history ETH 6h 1  ← 1% 이상 유지된 시간도 표시")
+        return
+
+    coin = context.args[0].upper()
+    try:
+        span = _parse_span(context.args[1]) if len(context.args) >= 2 else 86400
+        threshold = float(context.args[2]) if len(context.args) >= 3 else None
+    except:
+        await update.message.reply_text("기간은 30m / 24h / 7d 형식, 퍼센트는 숫자로 입력해줘.")
+        return
+    span = min(span, HISTORY_1H_DAYS * 86400)
+
+    # 6시간 이하는 1분, 그 이상은 1시간 롤업 (원본 틱은 읽지 않음)
+    kind = "1m" if span <= 6 * 3600 else "1h"
+    size = HISTORY_KINDS[kind][1]
+    t1 = int(_time.time()) + 1
+    rows = await asyncio.to_thread(HISTORY.query, coin, t1 - span, t1, kind)
+
+    if len(rows) == 0:
+        await update.message.reply_text(f"📈 {coin} 기록 없음")
+        return
+
+    hi = int(np.argmax(rows["max"]))
+    lo = int(np.argmin(rows["min"]))
+
+    # 화면용으로 최대 24칸에 맞춰 묶음 (칸별 마지막 값)
+    n = min(24, len(rows))
+    cells = np.array_split(rows["last"], n)
+    points = np.array([c[-1] for c in cells])
+    lo_v, hi_v = float(points.min()), float(points.max())
+    scale = (hi_v - lo_v) or 1
+    spark = "".join(SPARK[int((p - lo_v) / scale * (len(SPARK) - 1))] for p in points)
+
+    msg = (
+        f"📈 {coin} 괴리율 기록 ({context.args[1] if len(context.args) >= 2 else '24h'}, {kind} 단위)\n"
+        f"{spark}\n"
+        f"최고 : {float(rows['max'][hi]):+.3f}% ({_kst(int(rows['ts'][hi]))})\n"
+        f"최저 : {float(rows['min'][lo]):+.3f}% ({_kst(int(rows['ts'][lo]))})\n"
+        f"최근 : {float(rows['last'][-1]):+.3f}% ({_kst(int(rows['ts'][-1]))})\n"
+        + " / ".join(f"{EXCHANGE_NAME[ex]} {fmt(float(rows[ex][-1]))}원" for ex in HISTORY_PAIR)
+    )
+
+    if threshold is not None:
+        # 구간 전체가 |괴리율| ≥ 기준이었던 롤업만 셈 (보수적으로)
+        above = (np.minimum(np.abs(rows["min"]), np.abs(rows["max"])) >= threshold) & (np.sign(rows["min"]) == np.sign(rows["max"]))
+        ts = rows["ts"].astype(np.int64)
+        longest = run = 0
+        for i in range(len(rows)):
+            if above[i]:
+                run = run + 1 if i and above[i - 1] and ts[i] - ts[i - 1] == size else 1
+                longest = max(longest, run)
+        msg += (
+            f"\n\n{threshold}% 이상 유지 : 총 {int(above.sum()) * size // 60}분"
+            f" (최장 연속 {longest * size // 60}분)"
+        )
+
+    await update.message.reply_text(msg)
+
+
+#################################
+# 🧩 역할 분리 (fetcher 1 + evaluator N + sender 1, 유닉스 소켓 버스)
+#################################
+
+# 같은 호스트 안에서만 쓰는 간단한 pub/sub. fetcher 프로세스가 브로커를 띄움
+#   prices : fetcher → evaluator   {"prices": {거래소: {코인: 가격}}, "keys": [[코인, 고가, 저가], ...]}
+#   alarms : sender → fetcher/evaluator (알람/밤모드 바뀜 → DB 다시 읽기)
+#   send   : evaluator → sender    {"chat_id", "text", "coalesce"}
+# 줄 단위 JSON: {"op": "sub", "topics": [...]} / {"op": "pub", "topic", "data"} → {"topic", "data"}
+
+class Bus:
+    def __init__(self):
+        self.handlers = {}   # 토픽 → [콜백]
+        self.clients = {}    # (브로커) writer → 구독 토픽 set
+        self.writer = None   # (클라이언트) 브로커 연결
+        self.backlog = deque(maxlen=BUS_BACKLOG)  # 연결 끊긴 동안 보낼 메시지
+        self.broker = False
+
+    def subscribe(self, topic, handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic, data):
+        if self.broker:
+            self._fanout(topic, data)
+            return
+        line = json.dumps({"op": "pub", "topic": topic, "data": data}, ensure_ascii=False).encode() + b"\n"
+        if self.writer is None or self.writer.is_closing():
+            self.backlog.append(line)
+            return
+        self.writer.write(line)
+
+    def _fanout(self, topic, data):
+        self._dispatch(topic, data)
+        line = json.dumps({"topic": topic, "data": data}, ensure_ascii=False).encode() + b"\n"
+        for w, topics in list(self.clients.items()):
+            if topic not in topics:
+                continue
+            # 느린 구독자 때문에 브로커가 막히지 않도록 버퍼가 차면 버림
+            if w.transport.get_write_buffer_size() > BUS_MAX_BUFFER:
+                METRICS.inc("bus_dropped_total", [("topic", topic)])
+                continue
+            w.write(line)
+
+    def _dispatch(self, topic, data):
+        for handler in self.handlers.get(topic, ()):
+            try:
+                r = handler(data)
+                if asyncio.iscoroutine(r):
+                    asyncio.create_task(r)
+            except Exception as e:
+                print(f"[버스 처리 오류] {topic} → {e}")
+
+    async def serve(self, path):
+        self.broker = True
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self._client, path, limit=BUS_LINE_LIMIT)
+        print(f"[버스] {path} 대기")
+        return server
+
+    async def _client(self, reader, writer):
+        self.clients[writer] = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    msg = json.loads(line)
+                    if msg.get("op") == "sub":
+                        self.clients[writer].update(msg["topics"])
+                    elif msg.get("op") == "pub":
+                        self._fanout(msg["topic"], msg["data"])
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print(f"[버스 메시지 오류] {e}")
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            # 한도 넘는 줄(ValueError) 등 → 이 클라이언트만 끊음 (클라이언트가 다시 붙음)
+            print(f"[버스 클라이언트 오류] {e}")
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def connect(self, path, on_connect=None):
+        # 브로커(fetcher)가 재시작해도 다시 붙음
+        # 브로커는 끊긴 동안의 이벤트를 보관하지 않음 → on_connect 로 (재)연결마다 상태를 다시 맞춤
+        backoff = 1
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_unix_connection(path, limit=BUS_LINE_LIMIT)
+                writer.write(json.dumps({"op": "sub", "topics": list(self.handlers)}).encode() + b"\n")
+                while self.backlog:
+                    writer.write(self.backlog.popleft())
+                self.writer = writer
+                backoff = 1
+                print(f"[버스 연결] {path}")
+                if on_connect:
+                    on_connect()
+
+                while line := await reader.readline():
+                    try:
+                        msg = json.loads(line)
+                        topic, data = msg["topic"], msg["data"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        print(f"[버스 메시지 오류] {e}")
+                        continue
+                    self._dispatch(topic, data)
+            except (ConnectionError, FileNotFoundError, asyncio.IncompleteReadError) as e:
+                print(f"[버스 끊김] {e}")
+            except Exception as e:
+                # 한도 넘는 줄, on_connect 실패 등 → 구독 태스크가 죽지 않게 다시 붙음
+                print(f"[버스 오류] {type(e).__name__}: {e}")
+            if writer is not None:
+                writer.close()
+            self.writer = None
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+BUS = Bus()
+
+def shard_of(chat_id):
+    # 재시작/프로세스가 달라도 같은 값 (hash()는 프로세스마다 달라짐)
+    return zlib.crc32(str(chat_id).encode()) % SHARD_COUNT
+
+def my_alarms():
+    alarms = load_alarms()
+    if SHARD_COUNT <= 1:
+        return alarms
+    return [a for a in alarms if shard_of(a["chat_id"]) == SHARD_INDEX]
+
+def reload_alarms(_=None):
+    # 다른 프로세스(sender)가 DB를 바꿨음 → 메모리 캐시 버리고 다시 읽기
+    _MEM.pop("alarms", None)
+    _MEM.pop("night", None)
+    ALARM_INDEX.rebuild(my_alarms(), load_night())
+    for aid in ALERT_STATE.states:
+        ALARM_INDEX.set_active(aid, True)
+    ALERT_STATE.sweep(_time.time())
+    notify_alarms_changed()
+
+def publish_snapshot(snapshot, keys):
+    BUS.publish("prices", {
+        "ts": _time.time(),
+        "prices": snapshot,
+        "keys": [list(k) for k in keys],
+    })
+    METRICS.inc("bus_snapshots_total")
+
+class BusDispatcher:
+    # evaluator 용: 발송은 sender 에게 넘김 (속도 제한/묶음은 sender 의 DISPATCHER 가)
+    def enqueue(self, chat_id, text, coalesce=True):
+        BUS.publish("send", {"chat_id": chat_id, "text": text, "coalesce": coalesce})
+
+async def on_snapshot(data):
+    # 내 샤드에 있는 그룹만 평가
+    keys = [tuple(k) for k in data["keys"]]
+    keys = [k for k in keys if k in ALARM_INDEX.groups]
+    if not keys:
+        return
+    METRICS.observe("bus_snapshot_delay_seconds", max(0, _time.time() - data["ts"]))
+    try:
+        await evaluate_alarms(None, data["prices"], keys)
+    except Exception as e:
+        print(f"[알람 평가 오류] {e}")
+
+def on_send(data):
+    DISPATCHER.enqueue(data["chat_id"], data["text"], data.get("coalesce", True))
+
+async def run_role(role):
+    # 텔레그램 봇이 없는 역할 (fetcher / evaluator)
+    global DISPATCHER
+
+    db()
+    ALARM_INDEX.rebuild(my_alarms(), load_night())
+    BUS.subscribe("alarms", reload_alarms)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if role == "fetcher":
+        await BUS.serve(BUS_SOCKET)
+        asyncio.create_task(alarm_loop(None))
+        if STREAM_MODE:
+            for ex in STREAM_WS_URLS:
+                asyncio.create_task(price_stream(None, ex))
+        asyncio.create_task(history_loop())
+        asyncio.create_task(market_refresh_loop())
+    else:
+        ALERT_STATE.restore()
+        DISPATCHER = BusDispatcher()
+        BUS.subscribe("prices", on_snapshot)
+        # 끊긴 동안 놓친 "alarms" 이벤트 대신 연결될 때마다 DB에서 다시 읽음
+        asyncio.create_task(BUS.connect(BUS_SOCKET, on_connect=reload_alarms))
+        asyncio.create_task(alert_state_loop())
+        print(f"[evaluator {SHARD_INDEX}/{SHARD_COUNT}] 알람 {len(ALARM_INDEX.alarms)}개")
+
+    asyncio.create_task(loop_lag_monitor())
+    if METRICS_PORT:
+        await start_metrics_server()
+
+    await stop.wait()
+    if role == "fetcher":
+        HISTORY.flush_open()
+    else:
+        ALERT_STATE.save()
+    await close_http()
+
+def run_cluster():
+    # 한 호스트에서 역할별 프로세스 띄우고, 죽으면 다시 띄움
+    # Procfile 예) worker: ROLE=cluster EVALUATORS=4 python main.py
+    roles = [("fetcher", {})]
+    roles += [("evaluator", {"SHARD_INDEX": str(i), "SHARD_COUNT": str(EVALUATORS)}) for i in range(EVALUATORS)]
+    roles += [("sender", {})]
+
+    def spawn(i):
+        role, extra = roles[i]
+        env = dict(os.environ, ROLE=role, **extra)
+        # 지표 포트는 역할마다 하나씩
+        env["METRICS_PORT"] = str(METRICS_PORT + i) if METRICS_PORT else "0"
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    procs = [spawn(i) for i in range(len(roles))]
+    running = [True]
+
+    def shutdown(*_):
+        running[0] = False
+        for p in procs:
+            p.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while running[0]:
+        _time.sleep(1)
+        for i, p in enumerate(procs):
+            if running[0] and p.poll() is not None:
+                print(f"[클러스터] {roles[i][0]} 종료({p.returncode}) → 재시작")
+                procs[i] = spawn(i)
+
+    for p in procs:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+#################################
+# 🪝 웹훅 수신 (WEBHOOK_MODE=1, run_polling 대신)
+#################################
+
+async def _read_http_request(reader):
+    # → (메서드, 경로, 헤더, 본문), 연결 끝이면 None
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode().split(" ", 2)
+
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        k, v = h.decode().split(":", 1)
+        headers[k.strip().lower()] = v.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length > WEBHOOK_MAX_BODY:
+        raise ValueError(f"본문이 너무 큼 ({length})")
+    body = await reader.readexactly(length) if length else b""
+    return method, target.split("?")[0], headers, body
+
+def _webhook_handler(app):
+    async def handle(reader, writer):
+        try:
+            # 텔레그램은 keep-alive 로 연결을 재사용함
+            while True:
+                # 놀고 있거나 느린 연결이 처리 슬롯을 계속 잡고 있지 않도록
+                req = await asyncio.wait_for(_read_http_request(reader), WEBHOOK_READ_TIMEOUT)
+                if req is None:
+                    break
+                method, path, headers, body = req
+
+                if method != "POST" or path != WEBHOOK_PATH:
+                    status = "404 Not Found"
+                elif not hmac.compare_digest(
+                    headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+                ):
+                    status = "403 Forbidden"
+                    METRICS.inc("webhook_rejected_total")
+                else:
+                    # 큐에만 넣고 바로 200 → 처리는 PTB 가 concurrent_updates 한도 안에서 동시에
+                    try:
+                        update = Update.de_json(json.loads(body), app.bot)
+                        await app.update_queue.put(update)
+                        METRICS.inc("webhook_updates_total")
+                        status = "200 OK"
+                    except Exception as e:
+                        print(f"[웹훅 업데이트 오류] {e}")
+                        status = "400 Bad Request"
+
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode()
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            print(f"[웹훅 서버 오류] {e}")
+        finally:
+            writer.close()
+    return handle
+
+async def run_webhook(app):
+    # run_polling 과 같은 순서로 post_init / post_shutdown 호출
+    global WEBHOOK_SECRET
+
+    # 비밀값 없이 열면 포트에 닿는 누구나 아무 채팅인 척 업데이트를 보낼 수 있음
+    if not WEBHOOK_SECRET:
+        if not WEBHOOK_URL:
+            raise SystemExit("[웹훅] WEBHOOK_SECRET 없이 시작할 수 없음 (로컬 테스트도 지정 필요)")
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        print("[웹훅] WEBHOOK_SECRET 없음 → 무작위 생성해서 등록")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+
+    server = await asyncio.start_server(_webhook_handler(app), WEBHOOK_HOST, WEBHOOK_PORT)
+    print(f"[웹훅] http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    # 공개 주소가 있으면 등록. 재시작 동안 밀린 업데이트는 버리지 않고 다시 받음
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_WORKERS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        print(f"[웹훅 등록] {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 
 #################################
 # main
 #################################
 
 def main():
-    global _APP
+    if ROLE == "cluster":
+        run_cluster()
+        return
+    if ROLE in ("fetcher", "evaluator"):
+        asyncio.run(run_role(ROLE))
+        return
 
-    ensure_data_dir()
+    db()
+    ALARM_INDEX.rebuild(load_alarms(), load_night())
+    ALERT_STATE.restore()
 
-    app = (
+    builder = (
         ApplicationBuilder()
         .token(TOKEN)
         .connect_timeout(30)
         .read_timeout(30)
         .write_timeout(30)
         .pool_timeout(30)
-        .build()
     )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot")
+    if WEBHOOK_MODE:
+        builder = builder.concurrent_updates(WEBHOOK_WORKERS)
 
-    _APP = app
+    app = builder.build()
 
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("set", set_alarm))
@@ -736,14 +3661,43 @@ def main():
     app.add_handler(CommandHandler("night", night_toggle))
     app.add_handler(CommandHandler("gap", gap_cmd))
     app.add_handler(CommandHandler("status", status_cmd))
+    app.add_handler(CommandHandler("history", history_cmd))
     app.add_handler(CommandHandler("users", users_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
 
     async def start(app):
-        asyncio.create_task(alarm_loop(app))
+        asyncio.create_task(DISPATCHER.run(app.bot))
+        asyncio.create_task(dispatcher_report_loop())
+        if ROLE == "sender":
+            # 알람 조회/평가는 fetcher/evaluator 가 → 발송 요청만 받음
+            BUS.subscribe("send", on_send)
+            asyncio.create_task(BUS.connect(BUS_SOCKET))
+        else:
+            asyncio.create_task(alarm_loop(app))
+            if STREAM_MODE:
+                for ex in STREAM_WS_URLS:
+                    asyncio.create_task(price_stream(app, ex))
+            asyncio.create_task(alert_state_loop())
+            asyncio.create_task(history_loop())
         asyncio.create_task(gap_auto_loop())
+        asyncio.create_task(wallet_refresh_loop())
+        asyncio.create_task(market_refresh_loop())
+        asyncio.create_task(loop_lag_monitor())
+        if METRICS_PORT:
+            await start_metrics_server()
+
+    async def stop(app):
+        if ROLE != "sender":
+            ALERT_STATE.save()
+            HISTORY.flush_open()
+        await close_http()
 
     app.post_init = start
-    app.run_polling(drop_pending_updates=True)
+    app.post_shutdown = stop
+    if WEBHOOK_MODE:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
 if __name__ == "__main__":
     main()